@@ -0,0 +1,203 @@
+import io
+import json
+import random
+import threading
+import time
+
+# Error codes Bedrock and Polly return when we are going faster than our quota
+THROTTLING_ERROR_CODES = {
+    'ThrottlingException',
+    'Throttling',
+    'TooManyRequestsException',
+    'ServiceUnavailableException',
+    'ModelNotReadyException',
+}
+# Server side failures and timeouts that usually succeed when tried again
+TRANSIENT_ERROR_CODES = THROTTLING_ERROR_CODES | {
+    'InternalServerException',
+    'InternalFailure',
+    'ServiceFailure',
+    'ModelTimeoutException',
+    'ModelStreamErrorException',
+    'RequestTimeout',
+    'RequestTimeoutException',
+}
+
+# Requests per second and burst size allowed per service, shared by every client in the process
+SERVICE_RATE_LIMITS = {
+    'bedrock-runtime': (5.0, 10),
+    'polly': (20.0, 40),
+}
+DEFAULT_RATE_LIMIT = (10.0, 20)
+
+# Connection pool shared by all threads using a client; retries are handled by ResilientClient
+MAX_POOL_CONNECTIONS = 50
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(service_name):
+    with _buckets_lock:
+        if service_name not in _buckets:
+            rate, capacity = SERVICE_RATE_LIMITS.get(service_name, DEFAULT_RATE_LIMIT)
+            _buckets[service_name] = TokenBucket(rate, capacity)
+        return _buckets[service_name]
+
+
+def set_rate_limit(service_name, rate, capacity=None):
+    bucket = get_bucket(service_name)
+    with bucket.lock:
+        bucket.rate = rate
+        bucket.capacity = capacity or max(1, int(rate * 2))
+        bucket.tokens = min(bucket.tokens, bucket.capacity)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # Callers asking for the same key while a call is running wait for that call instead of starting their own
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+
+def is_retryable_error(error):
+    response = getattr(error, 'response', None) or {}
+    if response.get('Error', {}).get('Code') in TRANSIENT_ERROR_CODES:
+        return True
+    if response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500:
+        return True
+    from botocore.exceptions import ConnectionError, HTTPClientError
+
+    # Connection failures, dropped connections and read timeouts
+    return isinstance(error, (ConnectionError, HTTPClientError))
+
+
+class ResilientClient:
+    # Wraps a boto3 client: identical in-flight requests share one upstream call,
+    # every call goes through the service's token bucket, and throttling and
+    # transient server or connection errors are retried with jittered exponential backoff.
+    def __init__(self, client, service_name, max_retries=5, base_delay=0.5, max_delay=8.0):
+        self.client = client
+        self.service_name = service_name
+        self.bucket = get_bucket(service_name)
+        self.single_flight = SingleFlight()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def call_with_retry(self, method, **kwargs):
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                return getattr(self.client, method)(**kwargs)
+            except Exception as e:
+                if not is_retryable_error(e) or attempt >= self.max_retries:
+                    raise
+                delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+                time.sleep(random.uniform(0, delay))
+                attempt += 1
+
+    def coalesced_call(self, method, stream_key, **kwargs):
+        # Streaming bodies can only be read once, so the leader reads it and
+        # every caller gets its own in-memory copy
+        def fetch():
+            response = self.call_with_retry(method, **kwargs)
+            payload = response[stream_key].read()
+            return response, payload
+
+        key = (method, json.dumps(kwargs, sort_keys=True, default=str))
+        response, payload = self.single_flight.do(key, fetch)
+        shared = dict(response)
+        shared[stream_key] = io.BytesIO(payload)
+        return shared
+
+    def invoke_model(self, **kwargs):
+        return self.coalesced_call('invoke_model', 'body', **kwargs)
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        return self.call_with_retry('invoke_model_with_response_stream', **kwargs)
+
+    def synthesize_speech(self, **kwargs):
+        return self.coalesced_call('synthesize_speech', 'AudioStream', **kwargs)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service_name, region_name, endpoint_url=None):
+    # boto3 clients are thread safe and expensive to build, so each process keeps one per service and region
+    key = (service_name, region_name, endpoint_url)
+    with _clients_lock:
+        if key not in _clients:
+            import boto3
+            from botocore.config import Config
+
+            config = Config(
+                max_pool_connections=MAX_POOL_CONNECTIONS,
+                connect_timeout=CONNECT_TIMEOUT,
+                read_timeout=READ_TIMEOUT,
+                retries={'mode': 'standard', 'max_attempts': 1},
+            )
+            client = boto3.client(service_name, region_name=region_name, endpoint_url=endpoint_url, config=config)
+            _clients[key] = ResilientClient(client, service_name)
+        return _clients[key]
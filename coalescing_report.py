@@ -0,0 +1,63 @@
+import argparse
+import io
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from aws_clients import ResilientClient
+
+
+class ThrottlingStub:
+    # Stands in for a bedrock-runtime client: slow, and throttles its first few calls
+    def __init__(self, throttle_first, latency):
+        self.throttle_first = throttle_first
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def invoke_model(self, modelId, body):
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+        time.sleep(self.latency)
+        if call <= self.throttle_first:
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'InvokeModel')
+        return {'body': io.BytesIO(json.dumps({'content': [{'text': f"answer to {body}"}]}).encode())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that identical concurrent requests share one upstream call")
+    parser.add_argument('--callers', type=int, default=40)
+    parser.add_argument('--throttle-first', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.2)
+    args = parser.parse_args()
+
+    stub = ThrottlingStub(args.throttle_first, args.latency)
+    client = ResilientClient(stub, 'coalescing-report', base_delay=0.05)
+    barrier = threading.Barrier(args.callers)
+
+    def ask():
+        barrier.wait()
+        response = client.invoke_model(modelId='stub', body='What is on this slide?')
+        return json.loads(response['body'].read())['content'][0]['text']
+
+    t = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.callers) as executor:
+        answers = list(executor.map(lambda _: ask(), range(args.callers)))
+    elapsed = time.perf_counter() - t
+
+    expected_calls = args.throttle_first + 1
+    print(f"callers:         {args.callers}")
+    print(f"upstream calls:  {stub.calls} (expected {expected_calls}: {args.throttle_first} throttled + 1 success)")
+    print(f"distinct answers {len(set(answers))}, all callers answered: {len(answers) == args.callers}")
+    print(f"elapsed:         {elapsed * 1000:.0f} ms")
+    if stub.calls != expected_calls or len(set(answers)) != 1:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
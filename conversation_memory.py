@@ -0,0 +1,156 @@
+import json
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Turns kept word for word; older turns are folded into the rolling summary
+RECENT_TURNS = 3
+# Upper bound on what the conversation adds to each prompt
+MAX_HISTORY_TOKENS = 1200
+MAX_SUMMARY_TOKENS = 300
+
+SUMMARY_PROMPT = """Here is a summary of a student's conversation with their teaching assistant so far:
+
+{summary}
+
+And here are the next exchanges:
+
+{turns}
+
+Rewrite the summary so it also covers the new exchanges. Keep the topics asked about, what was explained and anything the student still seemed unsure of. Use at most {max_words} words and reply with the summary only."""
+
+# Summaries are written off the request path, shared by every conversation in the process
+_summary_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='conversation-summary')
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text, close enough to keep prompts under a cap
+    return (len(text) + 3) // 4
+
+
+def truncate_to_tokens(text, max_tokens, keep_end=False):
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    return text[-max_chars:] if keep_end else text[:max_chars]
+
+
+def format_turns(turns):
+    return "\n\n".join(f"Student: {question}\nAssistant: {answer}" for question, answer in turns)
+
+
+def make_bedrock_summarizer(bedrock, model_id):
+    def summarize(summary, turns):
+        request_body = {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": MAX_SUMMARY_TOKENS,
+            "temperature": 0,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": SUMMARY_PROMPT.format(summary=summary or "(nothing yet)", turns=format_turns(turns),
+                                                          max_words=MAX_SUMMARY_TOKENS * 3 // 4)
+                        }
+                    ]
+                }
+            ]
+        }
+        response = bedrock.invoke_model(modelId=model_id, body=json.dumps(request_body))
+        response_body = json.loads(response.get('body').read())
+        return response_body['content'][0]['text']
+    return summarize
+
+
+class ConversationMemory:
+    def __init__(self, summarize, recent_turns=RECENT_TURNS, max_history_tokens=MAX_HISTORY_TOKENS):
+        self.summarize = summarize
+        self.recent_turns = recent_turns
+        self.max_history_tokens = max_history_tokens
+        self.turns = deque()
+        self.summary = ""
+        # Turns that have left the verbatim window but are not in the summary yet
+        self.unsummarized = []
+        self.summarizing = False
+        self.lock = threading.Lock()
+        self.metrics = {
+            'turns': 0,
+            'summaries': 0,
+            'summary_failures': 0,
+            'history_tokens': 0,
+            'last_prompt_tokens': 0,
+            'max_prompt_tokens': 0,
+        }
+
+    def add_turn(self, question, answer):
+        with self.lock:
+            self.turns.append((question, answer))
+            self.metrics['turns'] += 1
+            while len(self.turns) > self.recent_turns:
+                self.unsummarized.append(self.turns.popleft())
+            if self.unsummarized and not self.summarizing:
+                self.summarizing = True
+                _summary_pool.submit(self._summarize_pending)
+
+    def _summarize_pending(self):
+        while True:
+            with self.lock:
+                if not self.unsummarized:
+                    self.summarizing = False
+                    return
+                # The batch stays in unsummarized, and so in the history, until its summary replaces it
+                summary, batch = self.summary, list(self.unsummarized)
+            try:
+                summary = self.summarize(summary, batch)
+                failed = False
+            except Exception:
+                # Keep the tail of the raw turns rather than losing them altogether
+                summary = (summary + "\n\n" + format_turns(batch)).strip()
+                failed = True
+            with self.lock:
+                self.summary = truncate_to_tokens(summary, MAX_SUMMARY_TOKENS, keep_end=True)
+                del self.unsummarized[:len(batch)]
+                self.metrics['summary_failures' if failed else 'summaries'] += 1
+
+    def history_text(self):
+        # Oldest material is dropped first so the newest exchange always survives the cap
+        with self.lock:
+            summary = self.summary
+            recent = list(self.unsummarized) + list(self.turns)
+
+        budget = self.max_history_tokens
+        kept = []
+        for turn in reversed(recent):
+            text = format_turns([turn])
+            cost = estimate_tokens(text)
+            if cost > budget:
+                if not kept:
+                    kept.append(truncate_to_tokens(text, budget, keep_end=True))
+                    budget = 0
+                break
+            kept.append(text)
+            budget -= cost
+
+        parts = []
+        if summary and budget > 0:
+            parts.append(f"Summary of the earlier conversation:\n{truncate_to_tokens(summary, budget, keep_end=True)}")
+        if kept:
+            parts.append("Most recent exchanges:\n" + "\n\n".join(reversed(kept)))
+        history = "\n\n".join(parts)
+        with self.lock:
+            self.metrics['history_tokens'] = estimate_tokens(history)
+        return history
+
+    def record_prompt(self, prompt):
+        tokens = estimate_tokens(prompt)
+        with self.lock:
+            self.metrics['last_prompt_tokens'] = tokens
+            self.metrics['max_prompt_tokens'] = max(self.metrics['max_prompt_tokens'], tokens)
+        return tokens
+
+    def get_metrics(self):
+        with self.lock:
+            return dict(self.metrics, verbatim_turns=len(self.turns), pending_summary_turns=len(self.unsummarized),
+                        summary_tokens=estimate_tokens(self.summary))
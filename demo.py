@@ -1,20 +1,37 @@
 import fitz  # PyMuPDF library for handling PDFs
 from collections import deque
-import boto3
+import argparse
+import io
 import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from aws_clients import ResilientClient, get_client, set_rate_limit
+from conversation_memory import ConversationMemory, make_bedrock_summarizer
+from slide_dedup import SlideGroups, collapse_context, page_label
+
+MODEL_ID = 'anthropic.claude-3-sonnet-20240229-v1:0'
+STUB_RATE_LIMIT = 1000
 
 class DoubtSolver:
-    def __init__(self, pdf_path, context_size=5):
+    def __init__(self, pdf_path, context_size=5, bedrock=None):
         self.pdf_document = fitz.open(pdf_path)
         self.current_page = 0
         self.context_size = context_size
         self.context = deque(maxlen=context_size)
+        # Text and repeated or build-up slide groups of every page, filled by load_page_texts for
+        # batch runs that answer from many threads
+        self.page_texts = None
+        self.slide_groups = None
         
         # Initialize AWS Bedrock client
-        self.bedrock = boto3.client(
-            service_name='bedrock-runtime',
-            region_name='ap-south-1'  # e.g., 'us-east-1'
-        )
+        self.bedrock = bedrock or get_client('bedrock-runtime', region_name='ap-south-1')  # e.g., 'us-east-1'
+
+        # Earlier questions and answers, so follow-up questions make sense
+        self.memory = ConversationMemory(make_bedrock_summarizer(self.bedrock, MODEL_ID))
         
         # Update context with initial pages
         for _ in range(min(context_size, len(self.pdf_document))):
@@ -41,12 +58,31 @@ class DoubtSolver:
     def get_current_page_content(self):
         return self.pdf_document[self.current_page].get_text()
 
-    def answer_question(self, question):
-        # Prepare the context for Claude
-        context = "\n\n".join([f"Page {page+1}:\n{content}" for page, content in self.context])
+    def load_page_texts(self):
+        self.page_texts = [page.get_text() for page in self.pdf_document]
+        # Fingerprinting is done once for the deck rather than on every question's context
+        self.slide_groups = SlideGroups(list(enumerate(self.page_texts)))
+
+    def context_for_page(self, page):
+        # The pages a reader would have in context after navigating up to this page
+        first_page = max(0, page - self.context_size + 1)
+        return [(page_num, self.page_texts[page_num]) for page_num in range(first_page, page + 1)]
+
+    def answer_question(self, question, page=None):
+        # Without a page this is the interactive session: current context plus conversation memory.
+        # With a page the question is answered on its own, which is what batch runs need.
+        if page is None:
+            collapsed = collapse_context(self.context)
+        else:
+            collapsed = [(page_label(pages), content) for pages, content in self.slide_groups.collapse(self.context_for_page(page))]
+        context = "\n\n".join([f"{label}:\n{content}" for label, content in collapsed])
+        history = self.memory.history_text() if page is None else ""
+        conversation = f"Conversation so far:\n\n{history}\n\n" if history else ""
         
         # Prepare the message for Claude 3 Sonnet
-        message_content = f"Context from the PDF:\n\n{context}\n\nQuestion: {question}\n\nPlease answer the question based on the context provided above. If the answer is not in the context, please say so."
+        message_content = f"Context from the PDF:\n\n{context}\n\n{conversation}Question: {question}\n\nPlease answer the question based on the context provided above. If the answer is not in the context, please say so."
+        if page is None:
+            self.memory.record_prompt(message_content)
 
         # Prepare the request body
         request_body = {
@@ -67,17 +103,165 @@ class DoubtSolver:
 
         # Call Claude 3 Sonnet model via AWS Bedrock
         response = self.bedrock.invoke_model(
-            modelId='anthropic.claude-3-sonnet-20240229-v1:0',
+            modelId=MODEL_ID,
             contentType="application/json",
             accept="application/json",
             body=json.dumps(request_body)
         )
         
         response_body = json.loads(response['body'].read())
-        return response_body['content'][0]['text']
+        answer = response_body['content'][0]['text']
+        if page is None:
+            self.memory.add_turn(question, answer)
+        return answer
+
+class ThrottlingError(Exception):
+    def __init__(self):
+        super().__init__("Rate exceeded")
+        self.response = {'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}
+
+class StubBedrock:
+    # Local stand-in for the Bedrock runtime: answers after a fixed delay and throttles a share of calls
+    def __init__(self, latency=0.2, throttle_rate=0.0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+
+    def invoke_model(self, **kwargs):
+        time.sleep(self.latency)
+        if random.random() < self.throttle_rate:
+            raise ThrottlingError()
+        prompt = json.loads(kwargs['body'])['messages'][0]['content'][0]['text']
+        question = prompt.rsplit("Question: ", 1)[-1].split("\n", 1)[0]
+        body = {'content': [{'type': 'text', 'text': f"Stub answer to: {question}"}]}
+        return {'body': io.BytesIO(json.dumps(body).encode('utf-8'))}
+
+def read_questions(path):
+    # Each line is {"page": <1-based page>, "question": "..."} with an optional "id"
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                item = json.loads(line)
+                item.setdefault('id', line_number)
+                yield item
+
+def compact_answers(path):
+    # Answers written by an earlier, interrupted run are kept once per id; anything else is dropped,
+    # including a partly written last line, so appending to the file stays valid JSONL
+    answers = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if 'answer' in result:
+                    answers.setdefault(result['id'], result)
+        with open(f"{path}.tmp", 'w') as f:
+            for result in answers.values():
+                f.write(json.dumps(result) + "\n")
+        os.replace(f"{path}.tmp", path)
+    return set(answers)
+
+def errors_path(output):
+    root, ext = os.path.splitext(output)
+    return f"{root}.errors{ext or '.jsonl'}"
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def run_batch(args):
+    if args.stub:
+        bedrock = ResilientClient(StubBedrock(args.stub_latency, args.stub_throttle_rate), 'bedrock-runtime')
+    else:
+        bedrock = get_client('bedrock-runtime', region_name=args.region, endpoint_url=args.endpoint_url)
+    # The stub has no quota to protect, so it is only rate limited when asked to be
+    rate = args.rate or (STUB_RATE_LIMIT if args.stub else None)
+    if rate:
+        set_rate_limit('bedrock-runtime', rate)
+
+    doubt_solver = DoubtSolver(args.pdf, bedrock=bedrock)
+    doubt_solver.load_page_texts()
+    page_count = len(doubt_solver.page_texts)
+    doubt_solver.pdf_document.close()
+
+    # Failed questions are retried on the next run, so the errors file only describes the latest one
+    answered = compact_answers(args.output)
+    pending = [item for item in read_questions(args.batch) if item['id'] not in answered]
+    print(f"{len(answered)} already answered, {len(pending)} to go", file=sys.stderr)
+    errors = args.errors or errors_path(args.output)
+
+    write_lock = threading.Lock()
+    latencies = []
+    failures = 0
+    interrupted = False
+
+    def answer(item):
+        started = time.perf_counter()
+        page = int(item['page']) - 1
+        if not 0 <= page < page_count:
+            raise ValueError(f"page {item['page']} is outside the PDF (1-{page_count})")
+        result = dict(item, answer=doubt_solver.answer_question(item['question'], page=page))
+        result['latency_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        return result
+
+    started = time.perf_counter()
+    with open(args.output, 'a') as output, open(errors, 'w') as error_output, \
+            ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {executor.submit(answer, item): item for item in pending}
+        try:
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                    latencies.append(result['latency_ms'])
+                    destination = output
+                except Exception as e:
+                    result = dict(futures[future], error=str(e))
+                    failures += 1
+                    destination = error_output
+                with write_lock:
+                    destination.write(json.dumps(result) + "\n")
+                    destination.flush()
+        except KeyboardInterrupt:
+            # Whatever was written so far is kept; running the same command again resumes from there
+            for future in futures:
+                future.cancel()
+            interrupted = True
+            print("interrupted, rerun to resume", file=sys.stderr)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"answered {len(latencies)}, failed {failures} in {elapsed:.1f} s "
+          f"({len(latencies) / elapsed if elapsed else 0:.1f} questions/s)", file=sys.stderr)
+    print(f"latency ms: p50 {percentile(latencies, 0.5):.0f}  p90 {percentile(latencies, 0.9):.0f}  "
+          f"p99 {percentile(latencies, 0.99):.0f}  max {latencies[-1] if latencies else 0:.0f}", file=sys.stderr)
+    if interrupted:
+        return 130
+    return 1 if failures else 0
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Ask questions about a PDF, interactively or in batch")
+    parser.add_argument('--pdf', default="python-course-for-assistant.pdf")
+    parser.add_argument('--batch', metavar='QUESTIONS_JSONL', help="answer every question in this file and exit")
+    parser.add_argument('--output', default="answers.jsonl", help="batch answers, appended to so runs can resume")
+    parser.add_argument('--errors', help="failed questions from the latest run (default: OUTPUT with .errors before the extension)")
+    parser.add_argument('--concurrency', type=int, default=8, help="questions in flight at once")
+    parser.add_argument('--rate', type=float, help="maximum Bedrock requests per second")
+    parser.add_argument('--region', default='ap-south-1')
+    parser.add_argument('--endpoint-url', help="send Bedrock calls to this URL, e.g. a local stub server")
+    parser.add_argument('--stub', action='store_true', help="use an in-process stub model instead of Bedrock")
+    parser.add_argument('--stub-latency', type=float, default=0.2)
+    parser.add_argument('--stub-throttle-rate', type=float, default=0.0)
+    return parser.parse_args()
 
 def main():
-    pdf_path = "python-course-for-assistant.pdf"
+    args = parse_args()
+    if args.batch:
+        sys.exit(run_batch(args))
+
+    pdf_path = args.pdf
     doubt_solver = DoubtSolver(pdf_path)
 
     while True:
@@ -1,13 +1,16 @@
 import streamlit as st
 import fitz  # PyMuPDF library for handling PDFs
 from collections import deque
-import boto3
 import json
-import speech_recognition as sr
 import tempfile
 import os
 import io
 import base64
+from aws_clients import get_client
+from conversation_memory import ConversationMemory, make_bedrock_summarizer
+from slide_dedup import collapse_context
+
+MODEL_ID = 'anthropic.claude-3-haiku-20240307-v1:0'
 
 class DoubtSolver:
     def __init__(self, pdf_file, context_size=5):
@@ -16,16 +19,12 @@ class DoubtSolver:
         self.context_size = context_size
         self.context = deque(maxlen=context_size)
 
-        # Initialize AWS Bedrock client
-        self.bedrock = boto3.client(
-            service_name='bedrock-runtime',
-            region_name='ap-south-1')  # Change this to your preferred region
-
-        # Initialize AWS Polly client
-        self.polly = boto3.client('polly', region_name='ap-south-1')  # Change this to your preferred region
+        # AWS Bedrock and Polly clients are shared by every upload in this process
+        self.bedrock = get_client('bedrock-runtime', region_name='ap-south-1')  # Change this to your preferred region
+        self.polly = get_client('polly', region_name='ap-south-1')  # Change this to your preferred region
 
-        # Initialize speech recognizer
-        self.recognizer = sr.Recognizer()
+        # Speech recognizer is created on first voice question
+        self.recognizer = None
 
         # Update context with initial pages
         for _ in range(min(context_size, len(self.pdf_document))):
@@ -59,11 +58,15 @@ class DoubtSolver:
         img = pix.tobytes("png")
         return img
 
-    def answer_question(self, question):
-        context = "\n\n".join([f"Page {page+1}:\n{content}" for page, content in self.context])
-        message_content = f"""Context from the PDF:\n\n {context}\n\nQuestion: {question}
+    def answer_question(self, question, memory=None):
+        context = "\n\n".join([f"{label}:\n{content}" for label, content in collapse_context(self.context)])
+        history = memory.history_text() if memory is not None else ""
+        conversation = f"Conversation so far:\n\n{history}\n\n" if history else ""
+        message_content = f"""Context from the PDF:\n\n {context}\n\n{conversation}Question: {question}
                             \n\n Please answer the question based on the context provided above. If the answer is not fully contained in the context, you may use your general knowledge to provide a more comprehensive answer. 
                             However, clearly distinguish between information from the context and additional information you're providing. If you're using information beyond the given context, please state so explicitly.keep your answer within 100 words"""
+        if memory is not None:
+            memory.record_prompt(message_content)
 
         request_body = {
             "anthropic_version": "bedrock-2023-05-31",
@@ -83,7 +86,7 @@ class DoubtSolver:
         }
 
         streaming_response = self.bedrock.invoke_model_with_response_stream(
-            modelId='anthropic.claude-3-haiku-20240307-v1:0', 
+            modelId=MODEL_ID, 
             body=json.dumps(request_body)
         )
 
@@ -95,6 +98,8 @@ class DoubtSolver:
                 full_answer += text_chunk
                 yield text_chunk
 
+        if memory is not None:
+            memory.add_turn(question, full_answer)
         return full_answer
 
     def explain_concept(self):
@@ -121,7 +126,7 @@ class DoubtSolver:
         }
 
         streaming_response = self.bedrock.invoke_model_with_response_stream(
-            modelId='anthropic.claude-3-haiku-20240307-v1:0', 
+            modelId=MODEL_ID, 
             body=json.dumps(request_body)
         )
 
@@ -144,6 +149,10 @@ class DoubtSolver:
         return response['AudioStream'].read()
 
     def listen_for_question(self):
+        import speech_recognition as sr
+
+        if self.recognizer is None:
+            self.recognizer = sr.Recognizer()
         with sr.Microphone() as source:
             st.write("Listening... Speak your question.")
             audio = self.recognizer.listen(source)
@@ -177,7 +186,7 @@ class DoubtSolver:
         st.write("Processing your question...")
         answer_placeholder = st.empty()
         full_answer = ""
-        for token in doubt_solver.answer_question(question):
+        for token in doubt_solver.answer_question(question, get_conversation_memory(doubt_solver)):
             full_answer += token
             answer_placeholder.markdown(f"### Answer:\n{full_answer}")
 
@@ -191,6 +200,9 @@ class DoubtSolver:
 
 
 def transcribe_audio_file(audio_file):
+    import speech_recognition as sr
+    from pydub import AudioSegment
+
     recognizer = sr.Recognizer()
     try:
         # Convert uploaded file to AudioSegment
@@ -209,6 +221,15 @@ def transcribe_audio_file(audio_file):
         st.error(f"Error in transcription: {str(e)}")
         return None
     
+def get_conversation_memory(doubt_solver):
+    # The DoubtSolver is shared between browser sessions, so each session keeps its own conversation,
+    # and a new PDF starts a new one
+    memory_solver, memory = st.session_state.get('conversation_memory', (None, None))
+    if memory_solver is not doubt_solver:
+        memory = ConversationMemory(make_bedrock_summarizer(doubt_solver.bedrock, MODEL_ID))
+        st.session_state.conversation_memory = (doubt_solver, memory)
+    return memory
+
 @st.cache_resource
 def get_doubt_solver(pdf_file):
     return DoubtSolver(pdf_file)
@@ -0,0 +1,147 @@
+import hashlib
+import random
+import re
+
+SHINGLE_SIZE = 3
+NUM_PERMUTATIONS = 64
+# Locality sensitive hashing: signatures are cut into bands, pages sharing any band are compared
+LSH_BANDS = 16
+MERSENNE_PRIME = (1 << 61) - 1
+
+# Consecutive pages where the earlier one is (almost) contained in the later are build-up slides
+BUILD_CONTAINMENT = 0.8
+# Any two pages this similar are treated as the same slide shown twice
+NEAR_DUPLICATE_SIMILARITY = 0.9
+
+_rng = random.Random(1)
+_PERMUTATIONS = [(_rng.randrange(1, MERSENNE_PRIME), _rng.randrange(0, MERSENNE_PRIME)) for _ in range(NUM_PERMUTATIONS)]
+
+
+def normalize(text):
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+
+def exact_hash(text):
+    return hashlib.sha1(normalize(text).encode('utf-8')).hexdigest()
+
+
+def shingles(text):
+    words = normalize(text).split(' ')
+    if len(words) <= SHINGLE_SIZE:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def minhash(shingle_set):
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+              for shingle in shingle_set]
+    return tuple(min((a * h + b) % MERSENNE_PRIME for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def estimated_jaccard(signature_a, signature_b):
+    return sum(a == b for a, b in zip(signature_a, signature_b)) / NUM_PERMUTATIONS
+
+
+def added_lines(previous_text, text):
+    # Lines on a build-up slide that weren't on the slide before it
+    previous = {normalize(line) for line in previous_text.splitlines()}
+    return [line for line in text.splitlines() if line.strip() and normalize(line) not in previous]
+
+
+class SlideGroups:
+    # Groups pages that are exact copies, near copies or build-up steps of one another.
+    # pages is a list of (page_number, text); page numbers need not be contiguous.
+    def __init__(self, pages):
+        self.texts = dict(pages)
+        self.page_numbers = sorted(self.texts)
+        self.hashes = {page: exact_hash(text) for page, text in pages}
+        shingle_sets = {page: shingles(text) for page, text in pages}
+        self.sizes = {page: len(shingle_set) for page, shingle_set in shingle_sets.items()}
+        self.signatures = {page: minhash(shingle_set) for page, shingle_set in shingle_sets.items()}
+        self.parent = {page: page for page in self.page_numbers}
+        # Pages without extractable text (image-only slides) all look alike, so they are never grouped
+        self.with_text = [page for page in self.page_numbers if normalize(self.texts[page])]
+
+        first_with_hash = {}
+        for page in self.with_text:
+            first = first_with_hash.setdefault(self.hashes[page], page)
+            if first != page:
+                self.union(first, page)
+
+        for earlier, later in zip(self.with_text, self.with_text[1:]):
+            if later == earlier + 1 and self.containment(earlier, later) >= BUILD_CONTAINMENT:
+                self.union(earlier, later)
+
+        for page_a, page_b in self.candidate_pairs():
+            if estimated_jaccard(self.signatures[page_a], self.signatures[page_b]) >= NEAR_DUPLICATE_SIMILARITY:
+                self.union(page_a, page_b)
+
+        self.groups = {}
+        for page in self.page_numbers:
+            self.groups.setdefault(self.find(page), []).append(page)
+
+    def find(self, page):
+        while self.parent[page] != page:
+            self.parent[page] = self.parent[self.parent[page]]
+            page = self.parent[page]
+        return page
+
+    def union(self, page_a, page_b):
+        root_a, root_b = self.find(page_a), self.find(page_b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    def candidate_pairs(self):
+        rows = NUM_PERMUTATIONS // LSH_BANDS
+        pairs = set()
+        for band in range(LSH_BANDS):
+            buckets = {}
+            for page in self.with_text:
+                buckets.setdefault(self.signatures[page][band * rows:(band + 1) * rows], []).append(page)
+            for bucket in buckets.values():
+                pairs.update((a, b) for i, a in enumerate(bucket) for b in bucket[i + 1:])
+        return pairs
+
+    def containment(self, page_a, page_b):
+        # Estimated share of page_a's shingles that also appear on page_b
+        jaccard = estimated_jaccard(self.signatures[page_a], self.signatures[page_b])
+        size_a, size_b = self.sizes[page_a], self.sizes[page_b]
+        return min(1.0, jaccard * (size_a + size_b) / ((1 + jaccard) * size_a))
+
+    def members(self, page):
+        return self.groups[self.find(page)]
+
+    def exact_duplicate_of(self, page):
+        # The first page with exactly the same text, if it isn't this page
+        for member in self.members(page):
+            if member >= page:
+                return None
+            if self.hashes[member] == self.hashes[page]:
+                return member
+        return None
+
+    def previous_in_group(self, page):
+        earlier = [member for member in self.members(page) if member < page]
+        return earlier[-1] if earlier else None
+
+    def collapse(self, pages):
+        # Each group is represented once, by its latest page among the given ones (the most complete build step)
+        grouped = {}
+        for page, text in pages:
+            grouped.setdefault(self.find(page), {})[page] = text
+        collapsed = [(sorted(members), members[max(members)]) for members in grouped.values()]
+        return sorted(collapsed, key=lambda item: item[0][-1])
+
+
+def page_label(pages):
+    if len(pages) == 1:
+        return f"Page {pages[0] + 1}"
+    if pages[-1] - pages[0] == len(pages) - 1:
+        return f"Pages {pages[0] + 1}-{pages[-1] + 1}"
+    return "Pages " + ", ".join(str(page + 1) for page in pages)
+
+
+def collapse_context(context):
+    # For a context of (page, text) entries without a precomputed grouping of the whole deck
+    pages = list(dict(context).items())
+    return [(page_label(pages_in_group), text) for pages_in_group, text in SlideGroups(pages).collapse(pages)]
@@ -0,0 +1,171 @@
+import functools
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+
+from flask import jsonify
+
+# Lower priority number is served first when a slot frees up. Each class has its own
+# concurrency limit, queue bound (overall and per session) and maximum time a request
+# may wait in the queue.
+ENDPOINT_CLASSES = {
+    'navigation': {'priority': 0, 'max_concurrency': 8, 'max_queue': 64, 'max_queue_per_session': 16, 'max_wait': 2.0},
+    'upload': {'priority': 1, 'max_concurrency': 2, 'max_queue': 4, 'max_queue_per_session': 1, 'max_wait': 10.0},
+    'expensive': {'priority': 2, 'max_concurrency': 4, 'max_queue': 32, 'max_queue_per_session': 4, 'max_wait': 15.0},
+}
+TOTAL_CONCURRENCY = 12
+
+# Recent queue waits kept per class for the percentiles in the metrics
+WAIT_SAMPLES = 500
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self, session_id):
+        # A request without a session id is queued on its own and has no per-session bound
+        self.session_id = session_id if session_id is not None else self
+        self.granted = threading.Event()
+        self.enqueued_at = time.monotonic()
+
+
+class _EndpointClass:
+    def __init__(self, name, priority, max_concurrency, max_queue, max_queue_per_session, max_wait):
+        self.name = name
+        self.priority = priority
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_session = max_queue_per_session
+        self.max_wait = max_wait
+        self.active = 0
+        self.queued = 0
+        # Waiting requests grouped by session; sessions take turns so one client can't fill the class
+        self.sessions = OrderedDict()
+        self.service_time = 1.0
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+        self.counters = {'admitted': 0, 'rejected_queue_full': 0, 'rejected_deadline': 0, 'max_queue_depth': 0}
+
+    def enqueue(self, waiter):
+        self.sessions.setdefault(waiter.session_id, deque()).append(waiter)
+        self.queued += 1
+        self.counters['max_queue_depth'] = max(self.counters['max_queue_depth'], self.queued)
+
+    def dequeue_next(self):
+        session_id, waiters = next(iter(self.sessions.items()))
+        waiter = waiters.popleft()
+        if waiters:
+            self.sessions.move_to_end(session_id)
+        else:
+            del self.sessions[session_id]
+        self.queued -= 1
+        return waiter
+
+    def remove(self, waiter):
+        waiters = self.sessions.get(waiter.session_id)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self.sessions[waiter.session_id]
+            self.queued -= 1
+
+    def estimated_wait(self, position):
+        return position * self.service_time / self.max_concurrency
+
+    def retry_after(self):
+        return max(1, math.ceil(self.estimated_wait(self.queued + 1)))
+
+
+class AdmissionScheduler:
+    def __init__(self, endpoint_classes=ENDPOINT_CLASSES, total_concurrency=TOTAL_CONCURRENCY):
+        self.classes = {name: _EndpointClass(name, **config) for name, config in endpoint_classes.items()}
+        self.by_priority = sorted(self.classes.values(), key=lambda endpoint_class: endpoint_class.priority)
+        self.total_concurrency = total_concurrency
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, class_name, session_id):
+        endpoint_class = self.classes[class_name]
+        with self.lock:
+            session_queued = len(endpoint_class.sessions.get(session_id, ())) if session_id is not None else 0
+            if endpoint_class.queued >= endpoint_class.max_queue or session_queued >= endpoint_class.max_queue_per_session:
+                endpoint_class.counters['rejected_queue_full'] += 1
+                raise AdmissionRejected(429, 'Too many requests queued, please retry', endpoint_class.retry_after())
+            # Fail fast when the queue ahead is already longer than we would be allowed to wait
+            if endpoint_class.estimated_wait(endpoint_class.queued) > endpoint_class.max_wait:
+                endpoint_class.counters['rejected_deadline'] += 1
+                raise AdmissionRejected(503, 'Server is busy, please retry', endpoint_class.retry_after())
+            waiter = _Waiter(session_id)
+            endpoint_class.enqueue(waiter)
+            self._dispatch()
+
+        if not waiter.granted.wait(endpoint_class.max_wait):
+            with self.lock:
+                if not waiter.granted.is_set():
+                    endpoint_class.remove(waiter)
+                    endpoint_class.counters['rejected_deadline'] += 1
+                    raise AdmissionRejected(503, 'Server is busy, please retry', endpoint_class.retry_after())
+        with self.lock:
+            endpoint_class.waits.append(time.monotonic() - waiter.enqueued_at)
+            endpoint_class.counters['admitted'] += 1
+        return endpoint_class, time.monotonic()
+
+    def release(self, ticket):
+        endpoint_class, started_at = ticket
+        with self.lock:
+            endpoint_class.active -= 1
+            self.active -= 1
+            # Smoothed service time drives the Retry-After hints and the fail-fast estimate
+            endpoint_class.service_time = 0.8 * endpoint_class.service_time + 0.2 * (time.monotonic() - started_at)
+            self._dispatch()
+
+    def _dispatch(self):
+        while self.active < self.total_concurrency:
+            for endpoint_class in self.by_priority:
+                if endpoint_class.queued and endpoint_class.active < endpoint_class.max_concurrency:
+                    endpoint_class.dequeue_next().granted.set()
+                    endpoint_class.active += 1
+                    self.active += 1
+                    break
+            else:
+                return
+
+    def metrics(self):
+        with self.lock:
+            report = {'active': self.active, 'total_concurrency': self.total_concurrency, 'classes': {}}
+            for name, endpoint_class in self.classes.items():
+                waits = sorted(endpoint_class.waits)
+                report['classes'][name] = dict(
+                    endpoint_class.counters,
+                    active=endpoint_class.active,
+                    queue_depth=endpoint_class.queued,
+                    service_time_ms=round(endpoint_class.service_time * 1000, 1),
+                    wait_p50_ms=round(waits[len(waits) // 2] * 1000, 1) if waits else 0,
+                    wait_p95_ms=round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0,
+                )
+            return report
+
+    def admit(self, class_name, session_id):
+        # Route decorator: rejected requests get their status code and a Retry-After header straight away
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                try:
+                    ticket = self.acquire(class_name, session_id())
+                except AdmissionRejected as e:
+                    response = jsonify({'error': e.message})
+                    response.status_code = e.status
+                    response.headers['Retry-After'] = str(e.retry_after)
+                    return response
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    self.release(ticket)
+            return wrapper
+        return decorator
@@ -0,0 +1,153 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+STORE_DIR = os.environ.get('DOUBT_SOLVER_STORE', os.path.join(os.path.expanduser('~'), '.cache', 'doubt_solver'))
+MAX_STORE_BYTES = int(os.environ.get('DOUBT_SOLVER_STORE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+
+# Small artifacts such as page text live in the database, larger ones (images, audio) in blob files
+INLINE_LIMIT = 16 * 1024
+# Access times only steer eviction, so reads record them in memory and write them out in batches
+ACCESS_FLUSH_INTERVAL = 30.0
+
+
+def sha256_hex(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def version_key(*params):
+    # Artifacts are looked up by the parameters that produced them, so changing
+    # a prompt, model or render setting never serves a stale artifact
+    return sha256_hex("\x1f".join(str(param) for param in params).encode('utf-8'))[:16]
+
+
+class ArtifactStore:
+    # Artifacts are keyed by (document SHA-256, kind, key, version) and evicted
+    # least recently used first once the store grows past max_bytes
+    def __init__(self, root=STORE_DIR, max_bytes=MAX_STORE_BYTES):
+        self.root = root
+        self.blob_dir = os.path.join(root, 'blobs')
+        self.max_bytes = max_bytes
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(root, 'artifacts.db'), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # With WAL a crash can lose the last few commits but never corrupts the database; artifacts can be recomputed
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS artifacts (
+                document TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                version TEXT NOT NULL,
+                data BLOB,
+                path TEXT,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (document, kind, key, version)
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS artifacts_last_access ON artifacts (last_access)")
+        self.conn.commit()
+        self.total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+        self.pending_access = {}
+        self.flushed_at = time.monotonic()
+
+    def get(self, document, kind, key, version):
+        row_key = (document, kind, str(key), version)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data, path FROM artifacts WHERE document=? AND kind=? AND key=? AND version=?",
+                row_key).fetchone()
+            if row is None:
+                return None
+            self.pending_access[row_key] = time.time()
+            if time.monotonic() - self.flushed_at > ACCESS_FLUSH_INTERVAL:
+                self._flush_access()
+                self.conn.commit()
+        data, path = row
+        if path is None:
+            return data
+
+        # Blob files are read outside the lock so large reads don't hold up other lookups
+        full_path = os.path.join(self.blob_dir, path)
+        try:
+            with open(full_path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            with self.lock:
+                if not os.path.exists(full_path):
+                    self._delete(*row_key)
+                    self.conn.commit()
+            return None
+
+    def put(self, document, kind, key, version, data):
+        key = str(key)
+        path = None
+        inline = data
+        if len(data) > INLINE_LIMIT:
+            path = os.path.join(document[:2], version_key(document, kind, key, version))
+            full_path = os.path.join(self.blob_dir, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            # Write to a temporary file first so a crash never leaves a truncated blob behind
+            tmp_path = f"{full_path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, full_path)
+            inline = None
+
+        with self.lock:
+            self._delete(document, kind, key, version, keep_path=path)
+            self.conn.execute(
+                "INSERT INTO artifacts (document, kind, key, version, data, path, size, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (document, kind, key, version, inline, path, len(data), time.time()))
+            self.total += len(data)
+            self._evict()
+            self.conn.commit()
+
+    def total_size(self):
+        with self.lock:
+            return self.total
+
+    def _flush_access(self):
+        self.conn.executemany(
+            "UPDATE artifacts SET last_access=? WHERE document=? AND kind=? AND key=? AND version=?",
+            [(accessed_at, *row_key) for row_key, accessed_at in self.pending_access.items()])
+        self.pending_access = {}
+        self.flushed_at = time.monotonic()
+
+    def _evict(self, batch_size=100):
+        if self.total <= self.max_bytes:
+            return
+        self._flush_access()
+        while self.total > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT document, kind, key, version FROM artifacts ORDER BY last_access LIMIT ?",
+                (batch_size,)).fetchall()
+            if not rows:
+                break
+            for row_key in rows:
+                if self.total <= self.max_bytes:
+                    break
+                self._delete(*row_key)
+
+    def _delete(self, document, kind, key, version, keep_path=None):
+        row = self.conn.execute(
+            "SELECT size, path FROM artifacts WHERE document=? AND kind=? AND key=? AND version=?",
+            (document, kind, key, version)).fetchone()
+        if row is None:
+            return
+        size, path = row
+        self.total -= size
+        self.pending_access.pop((document, kind, key, version), None)
+        self.conn.execute(
+            "DELETE FROM artifacts WHERE document=? AND kind=? AND key=? AND version=?",
+            (document, kind, key, version))
+        if path is not None and path != keep_path:
+            try:
+                os.unlink(os.path.join(self.blob_dir, path))
+            except FileNotFoundError:
+                pass
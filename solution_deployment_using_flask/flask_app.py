@@ -1,67 +1,234 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import fitz  # PyMuPDF library for handling PDFs
-from collections import deque
-import boto3
+from flask_sock import Sock
+from collections import OrderedDict, deque
 import json
 import base64
 import io
-import speech_recognition as sr
-from pydub import AudioSegment
 import tempfile
 import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from admission import AdmissionScheduler
+from aws_clients import get_client
+from conversation_memory import ConversationMemory, make_bedrock_summarizer
+from slide_dedup import SlideGroups, added_lines, page_label
+from artifact_store import ArtifactStore, sha256_hex, version_key
+from lecture_mode import LecturePrefetcher
+from voice_session import SAMPLE_RATE, GoogleSpeechToText, PollyTextToSpeech, VoiceSession
+from page_rendering import (DEFAULT_DPI, PREVIEW_DPI, SPRITE_COLUMNS, THUMBNAIL_WIDTH, TILE_SIZE, PageSize,
+                            build_thumbnail_sprite, largest_untiled_dpi, needs_tiling, quantize_dpi, render_page,
+                            tile_grid)
+
+IMAGE_CACHE_SIZE = 64
+MAX_CONVERSATIONS = 1000
+MODEL_ID = 'anthropic.claude-3-haiku-20240307-v1:0'
+VOICE_ID = "Matthew"  # You can choose other voices supported by AWS Polly
+
+EXPLAIN_PROMPT = """Context from the PDF:\n\n Page {page_number}:\n{page_content}\n\n 
+        As an experienced technical instructor, present this slide's content to your students. Your explanation should:
+    
+        1. Start with a brief introduction (1-2 sentences) to capture attention and set the context.
+        2. Clearly state the main topic or concept (1 sentence).
+        3. Explain 2-3 key points or ideas, using simple language and relatable examples where possible.
+        4. If applicable, mention any important formulas, diagrams, or code snippets (briefly).
+        5. Conclude with a quick summary or takeaway (1-2 sentences).
+    
+        Your explanation should be concise yet informative, aiming for about 150 words and designed to be delivered in approximately 2 minutes. Use an engaging, conversational tone as if speaking directly to your students."""
+EXPLAIN_TEMPERATURE = 0.2  # Slightly increased for more natural language
+
+# Build-up slides only add a bullet or two to the slide before, so only the new part is explained
+BUILD_EXPLAIN_PROMPT = """You are presenting slides to your students. On the previous slide (page {previous_page}) you said:
+
+        {previous_explanation}
+
+        The current slide (page {page_number}) repeats that slide and adds the following:
+
+        {new_content}
+
+        Explain only what this slide adds, in about 60 words, continuing naturally from what you already said. Use an engaging, conversational tone as if speaking directly to your students."""
+
+# Stored artifacts are only reused when they were produced with the same parameters
+METADATA_VERSION = version_key('metadata', 1)
+TEXT_VERSION = version_key('get_text', 1)
+IMAGE_VERSION = version_key('png', TILE_SIZE)
+THUMBNAIL_VERSION = version_key('sprite', THUMBNAIL_WIDTH, SPRITE_COLUMNS)
+EXPLANATION_VERSION = version_key(MODEL_ID, EXPLAIN_PROMPT, BUILD_EXPLAIN_PROMPT, EXPLAIN_TEMPERATURE)
+AUDIO_VERSION = version_key('mp3', VOICE_ID)
 
 app = Flask(__name__)
 CORS(app)
+sock = Sock(app)
+
+artifact_store = None
+
+def get_artifact_store():
+    global artifact_store
+    if artifact_store is None:
+        artifact_store = ArtifactStore()
+    return artifact_store
 
 class DoubtSolver:
-    def __init__(self, pdf_file, context_size=5):
-        self.pdf_document = fitz.open(stream=pdf_file.read(), filetype="pdf")
+    def __init__(self, pdf_file, context_size=5, store=None):
+        self.pdf_bytes = pdf_file.read()
+        self.document_id = sha256_hex(self.pdf_bytes)
+        self.store = store or get_artifact_store()
+        # The PDF is only parsed when something is missing from the store
+        self._pdf_document = None
+        # PyMuPDF is not thread safe, so every access to the document goes through this lock
+        self.document_lock = threading.RLock()
+        # Page text is small and read on every navigation, so once loaded it stays in memory
+        self.page_texts = {}
+        self.page_sizes = self.load_page_sizes()
         self.current_page = 0
         self.context_size = context_size
         self.context = deque(maxlen=context_size)
-        self.all_slides_content = self.extract_all_slides_content()
-
-        # Initialize AWS Bedrock client
-        self.bedrock = boto3.client(
-            service_name='bedrock-runtime',
-            region_name='us-east-1')  # Change this to your preferred region
+        self._all_slides_content = None
+        self._slide_groups = None
 
-        # Initialize AWS Polly client
-        self.polly = boto3.client('polly', region_name='us-east-1')  # Change this to your preferred region
+        # AWS Bedrock and Polly clients are shared by every upload in this process
+        self.bedrock = get_client('bedrock-runtime', region_name='us-east-1')  # Change this to your preferred region
+        self.polly = get_client('polly', region_name='us-east-1')  # Change this to your preferred region
 
         # Update context with initial pages
-        for _ in range(min(context_size, len(self.pdf_document))):
+        for _ in range(min(context_size, self.page_count)):
             self.update_context()
 
+        # Thumbnails for the whole deck are rendered in the background and kept with the document
+        self.thumbnails = None
+        self.thumbnails_error = None
+        self.thumbnails_ready = threading.Event()
+
+        # Rendered pages and tiles, keyed by (page, dpi, tile) and evicted least recently used first
+        self.image_cache = OrderedDict()
+        # Separate from the document lock so cached pages never wait behind PyMuPDF work
+        self.image_cache_lock = threading.Lock()
+
+        # Created the first time a slide is taught in lecture mode. Concurrent requests must share one
+        # prefetcher, otherwise work queued on a second one could never be retargeted or cancelled
+        self.lecture = None
+        self.lecture_lock = threading.Lock()
+
+    @property
+    def pdf_document(self):
+        import fitz  # PyMuPDF library for handling PDFs, only needed when the store is missing something
+
+        with self.document_lock:
+            if self._pdf_document is None:
+                self._pdf_document = fitz.open(stream=self.pdf_bytes, filetype="pdf")
+            return self._pdf_document
+
+    @property
+    def page_count(self):
+        return len(self.page_sizes)
+
+    @property
+    def all_slides_content(self):
+        if self._all_slides_content is None:
+            self._all_slides_content = self.extract_all_slides_content()
+        return self._all_slides_content
+
+    @property
+    def slide_groups(self):
+        # Pages that repeat or build on each other, fingerprinted locally from the extracted text
+        if self._slide_groups is None:
+            self._slide_groups = SlideGroups(self.all_slides_content)
+        return self._slide_groups
+
+    def load_page_sizes(self):
+        stored = self.store.get(self.document_id, 'metadata', 'page_sizes', METADATA_VERSION)
+        if stored is not None:
+            return [PageSize(*size) for size in json.loads(stored)]
+        with self.document_lock:
+            page_sizes = [PageSize(page.rect.width, page.rect.height) for page in self.pdf_document]
+        self.store.put(self.document_id, 'metadata', 'page_sizes', METADATA_VERSION, json.dumps(page_sizes).encode('utf-8'))
+        return page_sizes
+
     def update_context(self):
-        page_content = self.pdf_document[self.current_page].get_text()
+        page_content = self.get_current_page_content()
         self.context.append((self.current_page, page_content))
     
     def extract_all_slides_content(self):
         all_content = []
-        for page_num in range(len(self.pdf_document)):
-            content = self.pdf_document[page_num].get_text()
+        for page_num in range(self.page_count):
+            content = self.get_page_content(page_num)
             all_content.append((page_num, content))
         return all_content
 
+    def get_page_content(self, page_number):
+        content = self.page_texts.get(page_number)
+        if content is not None:
+            return content
+        stored = self.store.get(self.document_id, 'text', page_number, TEXT_VERSION)
+        if stored is not None:
+            content = stored.decode('utf-8')
+        else:
+            with self.document_lock:
+                content = self.pdf_document[page_number].get_text()
+            self.store.put(self.document_id, 'text', page_number, TEXT_VERSION, content.encode('utf-8'))
+        self.page_texts[page_number] = content
+        return content
+
     def get_current_page_content(self):
-        return self.pdf_document[self.current_page].get_text()
+        return self.get_page_content(self.current_page)
 
     def get_current_page_image(self):
-        page = self.pdf_document[self.current_page]
-        pix = page.get_pixmap()
-        img = pix.tobytes("png")
+        return self.get_page_image(self.current_page, DEFAULT_DPI)
+
+    def get_page_size(self, page_number):
+        return self.page_sizes[page_number]
+
+    def get_page_image(self, page_number, dpi, tile=None):
+        key = (page_number, dpi, tile)
+        with self.image_cache_lock:
+            if key in self.image_cache:
+                self.image_cache.move_to_end(key)
+                return self.image_cache[key]
+        store_key = f"{page_number}:{dpi}:{tile}"
+        img = self.store.get(self.document_id, 'image', store_key, IMAGE_VERSION)
+        if img is None:
+            with self.document_lock:
+                img = render_page(self.pdf_document[page_number], dpi, tile)
+            self.store.put(self.document_id, 'image', store_key, IMAGE_VERSION, img)
+        with self.image_cache_lock:
+            self.image_cache[key] = img
+            if len(self.image_cache) > IMAGE_CACHE_SIZE:
+                self.image_cache.popitem(last=False)
         return img
 
+    def start_thumbnail_generation(self):
+        threading.Thread(target=self.generate_thumbnails, daemon=True).start()
+
+    def generate_thumbnails(self):
+        try:
+            sprite = self.store.get(self.document_id, 'thumbnails', 'sprite', THUMBNAIL_VERSION)
+            layout = self.store.get(self.document_id, 'thumbnails', 'layout', THUMBNAIL_VERSION)
+            if sprite is not None and layout is not None:
+                self.thumbnails = dict(json.loads(layout), sprite=sprite)
+                return
+            thumbnails = build_thumbnail_sprite(self.pdf_document, self.document_lock)
+            layout = {key: value for key, value in thumbnails.items() if key != 'sprite'}
+            self.store.put(self.document_id, 'thumbnails', 'sprite', THUMBNAIL_VERSION, thumbnails['sprite'])
+            self.store.put(self.document_id, 'thumbnails', 'layout', THUMBNAIL_VERSION, json.dumps(layout).encode('utf-8'))
+            self.thumbnails = thumbnails
+        except Exception as e:
+            self.thumbnails_error = str(e)
+        finally:
+            self.thumbnails_ready.set()
 
-    def answer_question(self, question):
-        current_context = "\n\n".join([f"Page {page+1}:\n{content}" for page, content in self.context])
-        all_slides = self.all_slides_content
+
+    def build_answer_request(self, question, memory=None):
+        # Build-up slides and repeats are sent once, as their most complete version
+        current_context = "\n\n".join([f"{page_label(pages)}:\n{content}" for pages, content in self.slide_groups.collapse(self.context)])
+        all_slides = [(page_label(pages), content) for pages, content in self.slide_groups.collapse(self.all_slides_content)]
+        history = memory.history_text() if memory is not None else ""
+        conversation = f"Conversation so far:\n\n{history}\n\n" if history else ""
     
         message_content = f"""Current context (recent slides):\n\n{current_context}
     
-        Question: {question}
+        {conversation}Question: {question}
     
         Please answer the question based primarily on the current context provided above. If the answer is not fully contained in the current context, you may refer to the content of all slides to check if the topic will be covered in upcoming slides. 
     
@@ -70,12 +237,16 @@ class DoubtSolver:
         2. If the answer is not in the current context but will be covered in a future slide, mention this fact and provide the future slide number. Do not give details from the future slide.
         3. If the answer is not in any slide, state that the topic is not covered in the presentation.
         4. Keep your answer within 150 words.
+        5. If the question follows up on the conversation so far, answer it in that light.
     
         Full content of all slides (for reference only, do not disclose future content details):
         {json.dumps(all_slides)}
         """
     
-        request_body = {
+        if memory is not None:
+            memory.record_prompt(message_content)
+
+        return {
             "anthropic_version": "bedrock-2023-05-31",
             "max_tokens": 1000,
             "temperature": 0.2,
@@ -91,14 +262,43 @@ class DoubtSolver:
                 }
             ]
         }
-    
+
+    def answer_question(self, question, memory=None):
+        request_body = self.build_answer_request(question, memory)
         response = self.bedrock.invoke_model(
-            modelId='anthropic.claude-3-haiku-20240307-v1:0', 
+            modelId=MODEL_ID, 
             body=json.dumps(request_body)
         )
     
         response_body = json.loads(response.get('body').read())
-        return response_body['content'][0]['text']
+        answer = response_body['content'][0]['text']
+        if memory is not None:
+            memory.add_turn(question, answer)
+        return answer
+
+    def stream_answer(self, question, memory=None):
+        # Same prompt as answer_question, but tokens are yielded as Bedrock produces them
+        request_body = self.build_answer_request(question, memory)
+        streaming_response = self.bedrock.invoke_model_with_response_stream(
+            modelId=MODEL_ID,
+            body=json.dumps(request_body)
+        )
+
+        full_answer = ""
+        events = streaming_response["body"]
+        try:
+            for event in events:
+                chunk = json.loads(event.get("chunk", {}).get("bytes", b"{}").decode())
+                if chunk.get("type") == "content_block_delta":
+                    text_chunk = chunk.get("delta", {}).get("text", "")
+                    full_answer += text_chunk
+                    yield text_chunk
+        finally:
+            # Also runs when the caller closes this generator early, so the HTTP stream is released
+            events.close()
+
+        if memory is not None:
+            memory.add_turn(question, full_answer)
 
     # def explain_concept(self):
     #     current_page_content = self.pdf_document[self.current_page].get_text()
@@ -132,22 +332,31 @@ class DoubtSolver:
         
         
     def explain_concept(self):
-        current_page_content = self.pdf_document[self.current_page].get_text()
-        message_content = f"""Context from the PDF:\n\n Page {self.current_page + 1}:\n{current_page_content}\n\n 
-        As an experienced technical instructor, present this slide's content to your students. Your explanation should:
-    
-        1. Start with a brief introduction (1-2 sentences) to capture attention and set the context.
-        2. Clearly state the main topic or concept (1 sentence).
-        3. Explain 2-3 key points or ideas, using simple language and relatable examples where possible.
-        4. If applicable, mention any important formulas, diagrams, or code snippets (briefly).
-        5. Conclude with a quick summary or takeaway (1-2 sentences).
-    
-        Your explanation should be concise yet informative, aiming for about 150 words and designed to be delivered in approximately 2 minutes. Use an engaging, conversational tone as if speaking directly to your students."""
+        return self.explain_page(self.current_page)
+
+    def explain_page(self, page_number):
+        stored = self.store.get(self.document_id, 'explanation', page_number, EXPLANATION_VERSION)
+        if stored is not None:
+            return stored.decode('utf-8')
+
+        # A repeated slide shares the explanation (and so the audio) of its first occurrence
+        duplicate_of = self.slide_groups.exact_duplicate_of(page_number)
+        if duplicate_of is not None:
+            explanation = self.explain_page(duplicate_of)
+            self.store.put(self.document_id, 'explanation', page_number, EXPLANATION_VERSION, explanation.encode('utf-8'))
+            return explanation
+
+        message_content = self.build_explain_prompt(page_number)
+        if message_content is None:
+            # Nothing new compared to the previous step of the build, so say the same thing again
+            explanation = self.explain_page(self.slide_groups.previous_in_group(page_number))
+            self.store.put(self.document_id, 'explanation', page_number, EXPLANATION_VERSION, explanation.encode('utf-8'))
+            return explanation
     
         request_body = {
             "anthropic_version": "bedrock-2023-05-31",
             "max_tokens": 1000,
-            "temperature": 0.2,  # Slightly increased for more natural language
+            "temperature": EXPLAIN_TEMPERATURE,
             "messages": [
                 {
                     "role": "user",
@@ -162,24 +371,88 @@ class DoubtSolver:
         }
     
         response = self.bedrock.invoke_model(
-            modelId='anthropic.claude-3-haiku-20240307-v1:0', 
+            modelId=MODEL_ID, 
             body=json.dumps(request_body)
         )
     
         response_body = json.loads(response.get('body').read())
-        return response_body['content'][0]['text']    
+        explanation = response_body['content'][0]['text']
+        self.store.put(self.document_id, 'explanation', page_number, EXPLANATION_VERSION, explanation.encode('utf-8'))
+        return explanation
+
+    def build_explain_prompt(self, page_number):
+        page_content = self.get_page_content(page_number)
+        previous_page = self.slide_groups.previous_in_group(page_number)
+        if previous_page is not None:
+            # Only diff against the previous step if it has been explained already, to avoid explaining a whole run
+            previous_explanation = self.store.get(self.document_id, 'explanation', previous_page, EXPLANATION_VERSION)
+            if previous_explanation is not None:
+                new_lines = added_lines(self.get_page_content(previous_page), page_content)
+                if not new_lines:
+                    return None
+                return BUILD_EXPLAIN_PROMPT.format(previous_page=previous_page + 1,
+                                                   previous_explanation=previous_explanation.decode('utf-8'),
+                                                   page_number=page_number + 1, new_content="\n".join(new_lines))
+        return EXPLAIN_PROMPT.format(page_number=page_number + 1, page_content=page_content)
+
+    def prepare_lecture(self, page_number):
+        explanation = self.explain_page(page_number)
+        return explanation, self.convert_text_to_speech(explanation)
+
+    def teach_in_lecture_mode(self):
+        # The current slide comes from the look-ahead if it was already prepared, then the next slides are queued
+        with self.lecture_lock:
+            if self.lecture is None:
+                self.lecture = LecturePrefetcher(self.prepare_lecture, self.page_count)
+        explanation, audio = self.lecture.get(self.current_page)
+        prefetching = self.lecture.advance(self.current_page)
+        return explanation, audio, prefetching
 
     def convert_text_to_speech(self, text):
+        # Audio only depends on the text and voice, so it is stored under the text's hash
+        text_hash = sha256_hex(text.encode('utf-8'))
+        stored = self.store.get(self.document_id, 'audio', text_hash, AUDIO_VERSION)
+        if stored is not None:
+            return stored
         response = self.polly.synthesize_speech(
             Text=text,
             OutputFormat="mp3",
-            VoiceId="Matthew"  # You can choose other voices supported by AWS Polly
+            VoiceId=VOICE_ID
         )
-        return response['AudioStream'].read()
+        audio = response['AudioStream'].read()
+        self.store.put(self.document_id, 'audio', text_hash, AUDIO_VERSION, audio)
+        return audio
 
 doubt_solver = None
 
+# Conversation memory per student session, oldest sessions dropped first
+conversations = OrderedDict()
+conversations_lock = threading.Lock()
+
+def get_session_id():
+    return request.headers.get('X-Session-Id') or request.remote_addr
+
+def get_admission_session_id():
+    # Only clients that name their session get a per-session queue share. Without the header every
+    # student behind the Streamlit server or a proxy would share one address and one share
+    return request.headers.get('X-Session-Id')
+
+# Admission control in front of the routes, so bursts of slow upstream work can't starve page navigation
+scheduler = AdmissionScheduler()
+
+def get_conversation(session_id):
+    with conversations_lock:
+        if session_id in conversations:
+            conversations.move_to_end(session_id)
+            return conversations[session_id]
+        memory = ConversationMemory(make_bedrock_summarizer(get_client('bedrock-runtime', region_name='us-east-1'), MODEL_ID))
+        conversations[session_id] = memory
+        if len(conversations) > MAX_CONVERSATIONS:
+            conversations.popitem(last=False)
+        return memory
+
 @app.route('/upload_pdf', methods=['POST'])
+@scheduler.admit('upload', get_admission_session_id)
 def upload_pdf():
     global doubt_solver
     if 'file' not in request.files:
@@ -188,28 +461,111 @@ def upload_pdf():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
     if file and file.filename.endswith('.pdf'):
-        doubt_solver = DoubtSolver(file)
+        pdf_bytes = file.read()
+        if doubt_solver is not None and doubt_solver.document_id == sha256_hex(pdf_bytes):
+            # The Streamlit client sends the PDF again on every rerun; the deck already loaded keeps its state
+            return jsonify({'message': 'PDF uploaded successfully'}), 200
+        if doubt_solver is not None and doubt_solver.lecture is not None:
+            doubt_solver.lecture.cancel_all()
+        doubt_solver = DoubtSolver(io.BytesIO(pdf_bytes))
+        # Questions about the previous deck would only mislead answers about this one
+        with conversations_lock:
+            conversations.clear()
+        doubt_solver.start_thumbnail_generation()
         return jsonify({'message': 'PDF uploaded successfully'}), 200
     return jsonify({'error': 'Invalid file type'}), 400
 
 @app.route('/get_page', methods=['GET'])
+@scheduler.admit('navigation', get_admission_session_id)
 def get_page():
     global doubt_solver
     if doubt_solver is None:
         return jsonify({'error': 'No PDF uploaded'}), 400
     page_number = int(request.args.get('page', doubt_solver.current_page))
+    if not 0 <= page_number < doubt_solver.page_count:
+        return jsonify({'error': 'Page out of range'}), 400
+    width = request.args.get('width', type=int)
+    dpi = request.args.get('dpi', type=int)
+    preview = request.args.get('preview', '0') == '1'
+
     doubt_solver.current_page = page_number
-    doubt_solver.update_context()
+    if doubt_solver.lecture is not None:
+        doubt_solver.lecture.retarget(page_number)
+    # A preview followed by the full image for the same page should only add it to the context once
+    if not doubt_solver.context or doubt_solver.context[-1][0] != page_number:
+        doubt_solver.update_context()
     content = doubt_solver.get_current_page_content()
-    image = base64.b64encode(doubt_solver.get_current_page_image()).decode('utf-8')
+
+    page_size = doubt_solver.get_page_size(page_number)
+    full_dpi = quantize_dpi(page_size, width=width, dpi=dpi)
+    # The tile grid describes the full resolution, so a preview response already tells the client about it
+    tiles = tile_grid(page_size, full_dpi) if needs_tiling(page_size, full_dpi) else None
+    image_dpi = PREVIEW_DPI if preview else full_dpi
+    if needs_tiling(page_size, image_dpi):
+        # Too large for one image: send the sharpest version that fits and let the client fetch tiles
+        image_dpi = largest_untiled_dpi(page_size, image_dpi) or PREVIEW_DPI
+    image = base64.b64encode(doubt_solver.get_page_image(page_number, image_dpi)).decode('utf-8')
     return jsonify({
         'content': content,
         'image': image,
+        'dpi': image_dpi,
+        'full_dpi': full_dpi,
+        'preview': image_dpi < full_dpi,
+        'tiles': tiles,
         'current_page': doubt_solver.current_page + 1,
-        'total_pages': len(doubt_solver.pdf_document)
+        'total_pages': doubt_solver.page_count
+    }), 200
+
+@app.route('/get_page_tile', methods=['GET'])
+@scheduler.admit('navigation', get_admission_session_id)
+def get_page_tile():
+    global doubt_solver
+    if doubt_solver is None:
+        return jsonify({'error': 'No PDF uploaded'}), 400
+    page_number = request.args.get('page', type=int)
+    dpi = request.args.get('dpi', type=int)
+    column = request.args.get('column', type=int)
+    row = request.args.get('row', type=int)
+    if None in (page_number, dpi, column, row):
+        return jsonify({'error': 'page, dpi, column and row are required'}), 400
+    if not 0 <= page_number < doubt_solver.page_count:
+        return jsonify({'error': 'Page out of range'}), 400
+    page_size = doubt_solver.get_page_size(page_number)
+    grid = tile_grid(page_size, quantize_dpi(page_size, dpi=dpi))
+    if not (0 <= column < grid['columns'] and 0 <= row < grid['rows']):
+        return jsonify({'error': 'Tile out of range'}), 400
+    image = doubt_solver.get_page_image(page_number, grid['dpi'], (column, row))
+    return jsonify({
+        'image': base64.b64encode(image).decode('utf-8'),
+        'page': page_number + 1,
+        'dpi': grid['dpi'],
+        'column': column,
+        'row': row
+    }), 200
+
+@app.route('/get_thumbnails', methods=['GET'])
+@scheduler.admit('navigation', get_admission_session_id)
+def get_thumbnails():
+    global doubt_solver
+    if doubt_solver is None:
+        return jsonify({'error': 'No PDF uploaded'}), 400
+    if not doubt_solver.thumbnails_ready.is_set():
+        return jsonify({'status': 'pending'}), 202
+    if doubt_solver.thumbnails is None:
+        return jsonify({'error': f"Failed to render thumbnails: {doubt_solver.thumbnails_error}"}), 500
+    thumbnails = doubt_solver.thumbnails
+    return jsonify({
+        'status': 'ready',
+        'sprite': base64.b64encode(thumbnails['sprite']).decode('utf-8'),
+        'cell_width': thumbnails['cell_width'],
+        'cell_height': thumbnails['cell_height'],
+        'columns': thumbnails['columns'],
+        'index': thumbnails['index'],
+        'total_pages': len(thumbnails['index'])
     }), 200
 
 @app.route('/answer_question', methods=['POST'])
+@scheduler.admit('expensive', get_admission_session_id)
 def answer_question():
     global doubt_solver
     if doubt_solver is None:
@@ -217,27 +573,91 @@ def answer_question():
     question = request.json.get('question')
     if not question:
         return jsonify({'error': 'No question provided'}), 400
-    answer = doubt_solver.answer_question(question)
+    memory = get_conversation(get_session_id())
+    answer = doubt_solver.answer_question(question, memory)
     audio = base64.b64encode(doubt_solver.convert_text_to_speech(answer)).decode('utf-8')
-    return jsonify({'answer': answer, 'audio': audio}), 200
+    return jsonify({'answer': answer, 'audio': audio, 'prompt_tokens': memory.metrics['last_prompt_tokens']}), 200
+
+@app.route('/conversation_metrics', methods=['GET'])
+def conversation_metrics():
+    with conversations_lock:
+        memories = dict(conversations)
+    session_memory = memories.get(get_session_id())
+    all_metrics = [memory.get_metrics() for memory in memories.values()]
+    return jsonify({
+        'session': session_memory.get_metrics() if session_memory is not None else None,
+        'sessions': len(all_metrics),
+        'max_prompt_tokens': max((metrics['max_prompt_tokens'] for metrics in all_metrics), default=0),
+        'max_history_tokens': max((metrics['history_tokens'] for metrics in all_metrics), default=0)
+    }), 200
 
 @app.route('/start_teaching', methods=['GET'])
+@scheduler.admit('expensive', get_admission_session_id)
 def start_teaching():
     global doubt_solver
     if doubt_solver is None:
         return jsonify({'error': 'No PDF uploaded'}), 400
+    if request.args.get('lecture', '0') == '1':
+        explanation, audio, prefetching = doubt_solver.teach_in_lecture_mode()
+        audio = base64.b64encode(audio).decode('utf-8')
+        return jsonify({
+            'explanation': explanation,
+            'audio': audio,
+            'prefetching': [page + 1 for page in prefetching]
+        }), 200
     explanation = doubt_solver.explain_concept()
     audio = base64.b64encode(doubt_solver.convert_text_to_speech(explanation)).decode('utf-8')
     return jsonify({'explanation': explanation, 'audio': audio}), 200
 
+@app.route('/admission_metrics', methods=['GET'])
+def admission_metrics():
+    return jsonify(scheduler.metrics()), 200
+
+@sock.route('/voice_session')
+def voice_session(ws):
+    # Protocol: binary frames are 16-bit mono PCM from the microphone; text frames are JSON control
+    # messages ({"type": "start", "sample_rate": 16000} or {"type": "end_of_utterance"}). The server
+    # answers with JSON events and binary MP3 chunks, one per spoken sentence.
+    global doubt_solver
+    if doubt_solver is None:
+        ws.send(json.dumps({'type': 'error', 'error': 'No PDF uploaded'}))
+        return
+    solver = doubt_solver
+    memory = get_conversation(get_session_id())
+    session = None
+    sample_rate = SAMPLE_RATE
+    try:
+        while True:
+            message = ws.receive()
+            if message is None:
+                break
+            if isinstance(message, str):
+                control = json.loads(message)
+                if control.get('type') == 'start' and session is None:
+                    sample_rate = int(control.get('sample_rate', SAMPLE_RATE))
+                elif control.get('type') == 'end_of_utterance' and session is not None:
+                    session.end_utterance()
+                continue
+            if session is None:
+                session = VoiceSession(ws.send, GoogleSpeechToText(), lambda question: solver.stream_answer(question, memory),
+                                       PollyTextToSpeech(solver), sample_rate)
+                session.send({'type': 'listening', 'sample_rate': sample_rate})
+            session.feed_audio(message)
+    finally:
+        if session is not None:
+            session.close()
+
 @app.route('/listen_for_question', methods=['POST'])
+@scheduler.admit('expensive', get_admission_session_id)
 def listen_for_question():
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
     file = request.files['file']
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
-    
+
+    import speech_recognition as sr  # Deferred so other endpoints don't pay for loading it
+
     recognizer = sr.Recognizer()
     try:
         # Save the uploaded file temporarily
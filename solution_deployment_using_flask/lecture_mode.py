@@ -0,0 +1,62 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# How far ahead of the slide being taught we prepare, and how many slides are prepared at once
+LOOKAHEAD_PAGES = 2
+MAX_PREFETCH_WORKERS = 2
+
+
+class LecturePrefetcher:
+    # While one slide is being taught, the next few slides' explanation and audio are
+    # prepared in the background. Work for slides the student has jumped away from is
+    # cancelled before it starts; a call that is already running finishes and is kept in the store.
+    def __init__(self, prepare, page_count, lookahead=LOOKAHEAD_PAGES, max_workers=MAX_PREFETCH_WORKERS):
+        self.prepare = prepare
+        self.page_count = page_count
+        self.lookahead = lookahead
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='lecture-prefetch')
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.closed = False
+
+    def window(self, page_number):
+        return range(page_number + 1, min(page_number + 1 + self.lookahead, self.page_count))
+
+    def get(self, page_number):
+        with self.lock:
+            future = self.pending.pop(page_number, None)
+        if future is not None:
+            try:
+                return future.result()
+            except Exception:
+                pass  # A cancelled or failed prefetch gets a fresh attempt for the student waiting on it
+        return self.prepare(page_number)
+
+    def advance(self, page_number):
+        # Called when page_number starts playing: keep its look-ahead window and schedule what is missing
+        window = self.window(page_number)
+        with self.lock:
+            if self.closed:
+                return []
+            self._cancel_outside(window)
+            for page in window:
+                if page not in self.pending:
+                    self.pending[page] = self.executor.submit(self.prepare, page)
+            return sorted(self.pending)
+
+    def retarget(self, page_number):
+        # Called on navigation: anything the student is no longer heading towards is dropped
+        with self.lock:
+            self._cancel_outside(range(page_number, page_number + 1 + self.lookahead))
+
+    def cancel_all(self):
+        # The document is being replaced, so the worker threads are stopped as well
+        with self.lock:
+            self.closed = True
+            self._cancel_outside(())
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _cancel_outside(self, pages):
+        for page in list(self.pending):
+            if page not in pages:
+                self.pending.pop(page).cancel()
@@ -0,0 +1,117 @@
+import math
+from collections import namedtuple
+
+# Page dimensions in points, stored with the document so layout decisions don't need to open the PDF
+PageSize = namedtuple('PageSize', ['width', 'height'])
+
+# Pages are only rendered at these resolutions so cached images can be reused across clients
+DPI_LEVELS = (36, 72, 144, 216)
+DEFAULT_DPI = 72
+PREVIEW_DPI = DPI_LEVELS[0]
+
+# Above this many pixels a page is served as tiles instead of one image
+MAX_PAGE_PIXELS = 2048 * 2048
+TILE_SIZE = 512
+# Only pages physically larger than A3 (posters, large diagrams) are ever tiled
+LARGE_PAGE_AREA = 842 * 1191
+
+# Thumbnails are laid out in a grid of fixed size cells so the client can slice the sprite with the index
+THUMBNAIL_WIDTH = 120
+SPRITE_COLUMNS = 10
+
+
+def is_large_page(page_size):
+    return page_size.width * page_size.height > LARGE_PAGE_AREA
+
+
+def quantize_dpi(page_size, width=None, dpi=None):
+    if width is not None:
+        dpi = width / page_size.width * 72
+    if dpi is None:
+        return DEFAULT_DPI
+    level = next((level for level in DPI_LEVELS if level >= dpi), DPI_LEVELS[-1])
+    # Rounding up must not push an ordinary page over the pixel cap; it is rounded down instead
+    if needs_tiling(page_size, level) and not is_large_page(page_size):
+        level = largest_untiled_dpi(page_size, level) or PREVIEW_DPI
+    return level
+
+
+def rendered_size(page_size, dpi):
+    scale = dpi / 72
+    return math.ceil(page_size.width * scale), math.ceil(page_size.height * scale)
+
+
+def needs_tiling(page_size, dpi):
+    width, height = rendered_size(page_size, dpi)
+    return width * height > MAX_PAGE_PIXELS
+
+
+def largest_untiled_dpi(page_size, dpi):
+    fitting = [level for level in DPI_LEVELS if level <= dpi and not needs_tiling(page_size, level)]
+    return fitting[-1] if fitting else None
+
+
+def tile_grid(page_size, dpi, tile_size=TILE_SIZE):
+    width, height = rendered_size(page_size, dpi)
+    return {
+        'dpi': dpi,
+        'tile_size': tile_size,
+        'columns': math.ceil(width / tile_size),
+        'rows': math.ceil(height / tile_size),
+    }
+
+
+def render_page(page, dpi, tile=None, tile_size=TILE_SIZE):
+    import fitz
+
+    scale = dpi / 72
+    matrix = fitz.Matrix(scale, scale)
+    if tile is None:
+        return page.get_pixmap(matrix=matrix).tobytes("png")
+
+    # Only the clipped part of the page is rasterized, so poster size pages never exist at full resolution
+    column, row = tile
+    step = tile_size / scale
+    x0 = page.rect.x0 + column * step
+    y0 = page.rect.y0 + row * step
+    clip = fitz.Rect(x0, y0, x0 + step, y0 + step) & page.rect
+    return page.get_pixmap(matrix=matrix, clip=clip).tobytes("png")
+
+
+def build_thumbnail_sprite(pdf_document, lock, width=THUMBNAIL_WIDTH, columns=SPRITE_COLUMNS):
+    import fitz
+
+    with lock:
+        page_rects = [pdf_document[page_num].rect for page_num in range(len(pdf_document))]
+
+    cell_width = width
+    cell_height = math.ceil(width * max(rect.height / rect.width for rect in page_rects))
+    rows = math.ceil(len(page_rects) / columns)
+
+    # Every page is placed onto one large sheet, which is then rasterized in a single pass
+    sprite_document = fitz.open()
+    sheet = sprite_document.new_page(width=columns * cell_width, height=rows * cell_height)
+    index = []
+    for page_num, rect in enumerate(page_rects):
+        scale = min(cell_width / rect.width, cell_height / rect.height)
+        x = (page_num % columns) * cell_width
+        y = (page_num // columns) * cell_height
+        target = fitz.Rect(x, y, x + rect.width * scale, y + rect.height * scale)
+        try:
+            with lock:
+                sheet.show_pdf_page(target, pdf_document, page_num)
+        except ValueError:
+            pass  # Blank pages have nothing to draw and stay as an empty cell
+        index.append([round(target.x0), round(target.y0), round(target.width), round(target.height)])
+
+    # The sheet holds its own copy of every page, so rasterizing it doesn't need the source document's lock
+    sprite = sheet.get_pixmap().tobytes("png")
+    sprite_document.close()
+
+    return {
+        'sprite': sprite,
+        'cell_width': cell_width,
+        'cell_height': cell_height,
+        'columns': columns,
+        'index': index,
+    }
@@ -5,7 +5,16 @@ import tempfile
 import os
 from audio_recorder_streamlit import audio_recorder
 import io
-from pydub import AudioSegment
+import time
+import uuid
+from PIL import Image
+
+API_URL = 'http://localhost:5000'
+PAGE_IMAGE_WIDTH = 1200
+# The backend answers 429 or 503 with a Retry-After header when it is overloaded
+BUSY_STATUSES = (429, 503)
+MAX_BUSY_RETRIES = 3
+MAX_RETRY_AFTER = 10
 
 def main():
     st.set_page_config(page_title="Voice-Enabled Doubt Solver", layout="wide")
@@ -24,11 +33,34 @@ def main():
         st.info("Please upload a PDF file to begin.")
 
 def initialize_session_state():
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
     if 'current_page' not in st.session_state:
         st.session_state.current_page = 1
     if 'total_pages' not in st.session_state:
         st.session_state.total_pages = 1
 
+def get_api():
+    # One HTTP session per browser session, so every request tells the backend which student it is for
+    if 'api' not in st.session_state:
+        api = requests.Session()
+        api.headers['X-Session-Id'] = st.session_state.session_id
+        st.session_state.api = api
+    return st.session_state.api
+
+def call_api(method, path, **kwargs):
+    for attempt in range(MAX_BUSY_RETRIES + 1):
+        response = get_api().request(method, f'{API_URL}{path}', **kwargs)
+        if response.status_code not in BUSY_STATUSES or attempt == MAX_BUSY_RETRIES:
+            return response
+        time.sleep(min(MAX_RETRY_AFTER, float(response.headers.get('Retry-After', 1))))
+
+def show_failure(message, response):
+    if response.status_code in BUSY_STATUSES:
+        st.warning(f"{message}: the server is busy, please try again in a moment.")
+    else:
+        st.error(f"{message}: {response.json().get('error', 'Unknown error')}")
+
 def set_custom_style():
     st.markdown("""
     <style>
@@ -47,15 +79,22 @@ def set_custom_style():
     """, unsafe_allow_html=True)
 
 def handle_pdf_upload(uploaded_file):
+    if st.session_state.get('uploaded_file_id') != (uploaded_file.name, uploaded_file.size):
+        st.session_state.uploaded_file_id = (uploaded_file.name, uploaded_file.size)
+        st.session_state.thumbnails = None
+        st.session_state.pdf_uploaded = False
     files = {'file': ('file.pdf', uploaded_file.getvalue(), 'application/pdf')}
     try:
-        response = requests.post('http://localhost:5000/upload_pdf', files=files)
+        response = call_api('POST', '/upload_pdf', files=files)
         if response.status_code == 200:
+            st.session_state.pdf_uploaded = True
             st.success("PDF uploaded successfully")
             return True
-        else:
-            st.error(f"Failed to upload PDF: {response.json().get('error', 'Unknown error')}")
-            return False
+        if response.status_code in BUSY_STATUSES and st.session_state.pdf_uploaded:
+            # The PDF is sent again on every rerun; the server already has it from an earlier one
+            return True
+        show_failure("Failed to upload PDF", response)
+        return False
     except requests.exceptions.ConnectionError:
         st.error("Failed to connect to the Flask server. Make sure it's running.")
         return False
@@ -69,6 +108,8 @@ def display_pdf_content():
     with col2:
         display_current_page()
 
+    display_thumbnail_strip()
+
 def display_navigation():
     st.markdown("### Navigation")
     page_number = st.number_input("Go to page", min_value=1, value=st.session_state.current_page, step=1, max_value=st.session_state.total_pages)
@@ -87,6 +128,35 @@ def display_navigation():
         if st.button("Next ▶"):
             navigate_to_page(st.session_state.current_page + 1)
 
+def get_thumbnails():
+    # The sprite only changes with the document, so one request per upload is enough
+    if st.session_state.get('thumbnails') is None:
+        try:
+            response = call_api('GET', '/get_thumbnails')
+        except requests.exceptions.ConnectionError:
+            return None
+        if response.status_code != 200:
+            return None
+        thumbnails = response.json()
+        thumbnails['sprite'] = Image.open(io.BytesIO(base64.b64decode(thumbnails['sprite'])))
+        st.session_state.thumbnails = thumbnails
+    return st.session_state.thumbnails
+
+def display_thumbnail_strip(columns=8):
+    with st.expander("All pages", expanded=False):
+        thumbnails = get_thumbnails()
+        if thumbnails is None:
+            st.info("Preparing page thumbnails...")
+            return
+        for row_start in range(0, len(thumbnails['index']), columns):
+            cols = st.columns(columns)
+            for offset, (x, y, width, height) in enumerate(thumbnails['index'][row_start:row_start + columns]):
+                page_number = row_start + offset + 1
+                with cols[offset]:
+                    st.image(thumbnails['sprite'].crop((x, y, x + width, y + height)), use_column_width=True)
+                    if st.button(f"Page {page_number}", key=f"thumbnail_{page_number}"):
+                        navigate_to_page(page_number)
+
 def navigate_to_page(page_number):
     if 1 <= page_number <= st.session_state.total_pages:
         st.session_state.current_page = page_number
@@ -96,7 +166,8 @@ def display_current_page():
     st.markdown(f"### Current Page: {st.session_state.current_page}")
     
     try:
-        response = requests.get(f'http://localhost:5000/get_page?page={st.session_state.current_page-1}')
+        # A small preview comes back quickly and is replaced by the full resolution image
+        response = call_api('GET', f'/get_page?page={st.session_state.current_page-1}&width={PAGE_IMAGE_WIDTH}&preview=1')
         if response.status_code == 200:
             page_data = response.json()
             st.session_state.total_pages = page_data['total_pages']
@@ -104,20 +175,43 @@ def display_current_page():
             col2_1, col2_2 = st.columns(2)
             
             with col2_1:
-                st.image(f"data:image/png;base64,{page_data['image']}", caption=f"Page {st.session_state.current_page}", use_column_width=True)
+                image_placeholder = st.empty()
+                image_placeholder.image(f"data:image/png;base64,{page_data['image']}", caption=f"Page {st.session_state.current_page}", use_column_width=True)
+                if page_data['preview']:
+                    full_response = call_api('GET', f'/get_page?page={st.session_state.current_page-1}&width={PAGE_IMAGE_WIDTH}')
+                    if full_response.status_code == 200:
+                        page_data = full_response.json()
+                        image_placeholder.image(f"data:image/png;base64,{page_data['image']}", caption=f"Page {st.session_state.current_page}", use_column_width=True)
+                if page_data['tiles']:
+                    display_page_tile(page_data['tiles'])
             
             with col2_2:
                 st.text_area("Page Content", value=page_data['content'], height=400, disabled=True)
         else:
-            st.error(f"Failed to get page content: {response.json().get('error', 'Unknown error')}")
+            show_failure("Failed to get page content", response)
     except requests.exceptions.ConnectionError:
         st.error("Failed to connect to the Flask server. Make sure it's running.")
 
+def display_page_tile(tiles):
+    # Very large pages are only available in full detail one tile at a time
+    st.markdown("**Zoom into part of this page**")
+    tile_col1, tile_col2 = st.columns(2)
+    with tile_col1:
+        column = st.number_input("Column", min_value=1, max_value=tiles['columns'], value=1, step=1) - 1
+    with tile_col2:
+        row = st.number_input("Row", min_value=1, max_value=tiles['rows'], value=1, step=1) - 1
+    response = call_api('GET', f"/get_page_tile?page={st.session_state.current_page-1}&dpi={tiles['dpi']}&column={column}&row={row}")
+    if response.status_code == 200:
+        st.image(f"data:image/png;base64,{response.json()['image']}", use_column_width=True)
+    else:
+        show_failure("Failed to get page tile", response)
+
 def display_question_section():
     st.markdown("### Ask a Question or Start Teaching")
     
+    lecture_mode = st.checkbox("Lecture mode (prepare the next slides while this one plays)", value=True)
     if st.button("Start Teaching"):
-        start_teaching()
+        start_teaching(lecture_mode)
 
     st.markdown("### Ask a Question")
     input_mode = st.radio("Choose input method:", ('Text', 'Voice'))
@@ -127,15 +221,15 @@ def display_question_section():
     else:
         handle_voice_input()
 
-def start_teaching():
+def start_teaching(lecture_mode=False):
     try:
-        response = requests.get('http://localhost:5000/start_teaching')
+        response = call_api('GET', f"/start_teaching?lecture={int(lecture_mode)}")
         if response.status_code == 200:
             explanation_data = response.json()
             st.markdown(f"### Explanation:\n{explanation_data['explanation']}")
             play_audio(explanation_data['audio'])
         else:
-            st.error(f"Failed to start teaching: {response.json().get('error', 'Unknown error')}")
+            show_failure("Failed to start teaching", response)
     except requests.exceptions.ConnectionError:
         st.error("Failed to connect to the Flask server. Make sure it's running.")
 
@@ -161,6 +255,8 @@ def handle_voice_input():
         st.warning("No audio recorded. Please try again.")
 
 def transcribe_audio(audio_bytes):
+    from pydub import AudioSegment  # Only needed for voice questions
+
     audio = AudioSegment.from_wav(io.BytesIO(audio_bytes))
     
     with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_audio_file:
@@ -168,12 +264,13 @@ def transcribe_audio(audio_bytes):
         temp_audio_file_path = temp_audio_file.name
 
     try:
-        files = {'file': ('question.wav', open(temp_audio_file_path, 'rb'), 'audio/wav')}
-        response = requests.post('http://localhost:5000/listen_for_question', files=files)
+        with open(temp_audio_file_path, 'rb') as f:
+            files = {'file': ('question.wav', f.read(), 'audio/wav')}
+        response = call_api('POST', '/listen_for_question', files=files)
         if response.status_code == 200:
             return response.json()['question']
         else:
-            st.error(f"Failed to recognize speech: {response.json().get('error', 'Unknown error')}")
+            show_failure("Failed to recognize speech", response)
             return None
     except requests.exceptions.ConnectionError:
         st.error("Failed to connect to the Flask server. Make sure it's running.")
@@ -183,13 +280,13 @@ def transcribe_audio(audio_bytes):
 
 def process_question(question):
     try:
-        response = requests.post('http://localhost:5000/answer_question', json={'question': question})
+        response = call_api('POST', '/answer_question', json={'question': question})
         if response.status_code == 200:
             answer_data = response.json()
             st.markdown(f"### Answer:\n{answer_data['answer']}")
             play_audio(answer_data['audio'])
         else:
-            st.error(f"Failed to get answer: {response.json().get('error', 'Unknown error')}")
+            show_failure("Failed to get answer", response)
     except requests.exceptions.ConnectionError:
         st.error("Failed to connect to the Flask server. Make sure it's running.")
 
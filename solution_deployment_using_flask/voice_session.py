@@ -0,0 +1,208 @@
+import json
+import math
+import re
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+# Audio arrives as 16-bit little-endian mono PCM
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+
+# End of utterance is declared after this much quiet following at least MIN_SPEECH_MS of speech
+SPEECH_RMS_THRESHOLD = 500
+END_OF_UTTERANCE_SILENCE_MS = 700
+MIN_SPEECH_MS = 200
+MAX_UTTERANCE_MS = 15000
+
+# Answer text is spoken one sentence at a time, as soon as each sentence is complete
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+MIN_SENTENCE_CHARS = 20
+
+
+def frame_rms(pcm):
+    samples = array('h')
+    samples.frombytes(pcm[:len(pcm) - len(pcm) % SAMPLE_WIDTH])
+    if not samples:
+        return 0
+    return math.sqrt(sum(sample * sample for sample in samples) / len(samples))
+
+
+class EndOfUtteranceDetector:
+    def __init__(self, sample_rate=SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.reset()
+
+    def reset(self):
+        self.buffer = bytearray()
+        self.speech_ms = 0
+        self.silence_ms = 0
+        self.last_speech_at = None
+
+    def feed(self, pcm):
+        # Returns the utterance's audio once it is complete, otherwise None
+        duration_ms = len(pcm) / SAMPLE_WIDTH / self.sample_rate * 1000
+        if frame_rms(pcm) >= SPEECH_RMS_THRESHOLD:
+            self.speech_ms += duration_ms
+            self.silence_ms = 0
+            self.last_speech_at = time.perf_counter()
+        elif self.speech_ms:
+            self.silence_ms += duration_ms
+        else:
+            return None  # Nothing said yet, so leading silence is not kept
+        self.buffer.extend(pcm)
+
+        utterance_ms = len(self.buffer) / SAMPLE_WIDTH / self.sample_rate * 1000
+        if (self.speech_ms >= MIN_SPEECH_MS and self.silence_ms >= END_OF_UTTERANCE_SILENCE_MS) \
+                or utterance_ms >= MAX_UTTERANCE_MS:
+            return self.flush()
+        return None
+
+    def flush(self):
+        if self.speech_ms < MIN_SPEECH_MS:
+            self.reset()
+            return None
+        utterance = bytes(self.buffer), self.last_speech_at
+        self.reset()
+        return utterance
+
+
+def split_sentences(text):
+    # Returns (complete sentences, remaining text); very short sentences wait for the next one
+    parts = SENTENCE_END.split(text)
+    sentences, pending = [], ""
+    for part in parts[:-1]:
+        pending = f"{pending} {part}".strip()
+        if len(pending) >= MIN_SENTENCE_CHARS:
+            sentences.append(pending)
+            pending = ""
+    remainder = f"{pending} {parts[-1]}" if pending else parts[-1]
+    return sentences, remainder
+
+
+class GoogleSpeechToText:
+    def transcribe(self, pcm, sample_rate):
+        import speech_recognition as sr
+
+        try:
+            return sr.Recognizer().recognize_google(sr.AudioData(pcm, sample_rate, SAMPLE_WIDTH))
+        except sr.UnknownValueError:
+            return ""
+
+
+class PollyTextToSpeech:
+    def __init__(self, doubt_solver):
+        self.doubt_solver = doubt_solver
+
+    def synthesize(self, text):
+        return self.doubt_solver.convert_text_to_speech(text)
+
+
+class VoiceSession:
+    # One bidirectional voice conversation. Audio chunks go in through feed_audio;
+    # JSON events and MP3 audio chunks come out through send. Each utterance is
+    # answered on its own thread so audio keeps flowing in while the answer
+    # streams out, and speaking again interrupts the answer in progress.
+    def __init__(self, send, stt, stream_answer, tts, sample_rate=SAMPLE_RATE):
+        self._send = send
+        self.send_lock = threading.Lock()
+        self.stt = stt
+        self.stream_answer = stream_answer
+        self.tts = tts
+        self.sample_rate = sample_rate
+        self.detector = EndOfUtteranceDetector(sample_rate)
+        self.answer_thread = None
+        self.cancelled = threading.Event()
+        # A single worker keeps synthesized sentences in order
+        self.tts_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='voice-tts')
+
+    def send(self, message):
+        with self.send_lock:
+            self._send(json.dumps(message) if isinstance(message, dict) else message)
+
+    def feed_audio(self, pcm):
+        was_listening = self.detector.speech_ms == 0
+        utterance = self.detector.feed(pcm)
+        if was_listening and self.detector.speech_ms and self.is_answering():
+            self.cancelled.set()  # The student started talking over the answer
+        if utterance is not None:
+            self.start_answer(*utterance)
+
+    def end_utterance(self):
+        utterance = self.detector.flush()
+        if utterance is not None:
+            self.start_answer(*utterance)
+
+    def is_answering(self):
+        return self.answer_thread is not None and self.answer_thread.is_alive()
+
+    def start_answer(self, pcm, speech_ended_at):
+        # The previous answer is told to stop but not waited for, so a slow STT or TTS call
+        # never holds up the audio still arriving on the socket
+        self.cancelled.set()
+        self.cancelled = threading.Event()
+        self.answer_thread = threading.Thread(target=self.answer, args=(pcm, speech_ended_at, self.cancelled), daemon=True)
+        self.answer_thread.start()
+
+    def answer(self, pcm, speech_ended_at, cancelled):
+        timings = {}
+        first_audio = []
+
+        def elapsed_ms():
+            return round((time.perf_counter() - speech_ended_at) * 1000, 1)
+
+        def speak(sentence, index):
+            if cancelled.is_set():
+                return
+            audio = self.tts.synthesize(sentence)
+            if cancelled.is_set():
+                return
+            if not first_audio:
+                first_audio.append(elapsed_ms())
+            self.send({'type': 'audio', 'index': index, 'format': 'mp3', 'text': sentence})
+            self.send(audio)
+
+        try:
+            self.send({'type': 'utterance_end'})
+            question = self.stt.transcribe(pcm, self.sample_rate)
+            if cancelled.is_set():
+                return
+            timings['transcript_ms'] = elapsed_ms()
+            self.send({'type': 'transcript', 'text': question})
+            if not question:
+                return
+
+            answer, pending, spoken = "", "", []
+            tokens = self.stream_answer(question)
+            try:
+                for token in tokens:
+                    if cancelled.is_set():
+                        break
+                    if not answer:
+                        timings['first_token_ms'] = elapsed_ms()
+                    answer += token
+                    self.send({'type': 'answer_token', 'text': token})
+                    sentences, pending = split_sentences(pending + token)
+                    for sentence in sentences:
+                        spoken.append(self.tts_pool.submit(speak, sentence, len(spoken)))
+            finally:
+                # Stops the model's response stream straight away when the answer is interrupted
+                tokens.close()
+            if pending.strip() and not cancelled.is_set():
+                spoken.append(self.tts_pool.submit(speak, pending.strip(), len(spoken)))
+            for future in spoken:
+                future.result()
+
+            timings['answer_ms'] = elapsed_ms()
+            if first_audio:
+                timings['speech_end_to_first_audio_ms'] = first_audio[0]
+            self.send({'type': 'answer_done', 'answer': answer, 'interrupted': cancelled.is_set(), 'timings': timings})
+        except Exception as e:
+            self.send({'type': 'error', 'error': str(e)})
+
+    def close(self):
+        self.cancelled.set()
+        if self.answer_thread is not None:
+            self.answer_thread.join()
+        self.tts_pool.shutdown(wait=False)
@@ -0,0 +1,130 @@
+import argparse
+import io
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FLASK_DIR = os.path.join(ROOT, 'solution_deployment_using_flask')
+
+# What flask_app.py used to import at module load, before the heavy ones were deferred
+EAGER_IMPORTS = "import flask, flask_cors, fitz, boto3, speech_recognition, pydub"
+LAZY_IMPORTS = "import flask_app"
+
+
+def time_import(statement, runs):
+    # Each run is a fresh interpreter so nothing is already in sys.modules
+    code = f"import time; t = time.perf_counter(); {statement}; print(time.perf_counter() - t)"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([FLASK_DIR, ROOT]))
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], cwd=FLASK_DIR, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return timings
+
+
+def make_pdf(pages=20):
+    import fitz
+
+    doc = fitz.open()
+    for page_num in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Slide {page_num + 1}\nSome lecture content for this slide.")
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def measure(fn, runs):
+    timings = []
+    tracemalloc.start()
+    for _ in range(runs):
+        t = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - t)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return timings, peak
+
+
+def fresh_clients():
+    import boto3
+
+    boto3.client(service_name='bedrock-runtime', region_name='us-east-1')
+    boto3.client('polly', region_name='us-east-1')
+
+
+def shared_clients():
+    from aws_clients import get_client
+
+    get_client('bedrock-runtime', region_name='us-east-1')
+    get_client('polly', region_name='us-east-1')
+
+
+def baseline_upload(pdf):
+    # What DoubtSolver.__init__ did before: parse the PDF, extract every page, build new clients
+    import boto3
+    import fitz
+
+    document = fitz.open(stream=pdf, filetype="pdf")
+    [document[page_num].get_text() for page_num in range(len(document))]
+    boto3.client(service_name='bedrock-runtime', region_name='us-east-1')
+    boto3.client('polly', region_name='us-east-1')
+    [document[page_num].get_text() for page_num in range(min(5, len(document)))]
+
+
+def format_row(label, timings, peak=None):
+    row = f"{label:<40} median {statistics.median(timings) * 1000:8.1f} ms   max {max(timings) * 1000:8.1f} ms"
+    if peak is not None:
+        row += f"   peak {peak / 1024 / 1024:6.1f} MB"
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report backend startup time and per-upload overhead")
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    # Keep the report's artifacts out of the real store so every run starts from the same state
+    store_dir = tempfile.mkdtemp(prefix='startup_report_')
+    os.environ['DOUBT_SOLVER_STORE'] = store_dir
+    sys.path.insert(0, FLASK_DIR)
+    sys.path.insert(0, ROOT)
+
+    print("Module import (fresh interpreter)")
+    print(format_row("before: eager imports", time_import(EAGER_IMPORTS, args.runs)))
+    print(format_row("after: import flask_app", time_import(LAZY_IMPORTS, args.runs)))
+
+    print("\nAWS clients per upload")
+    timings, peak = measure(fresh_clients, args.runs)
+    print(format_row("before: new boto3 clients", timings, peak))
+    shared_clients()  # The first upload in a process still builds the clients once
+    timings, peak = measure(shared_clients, args.runs)
+    print(format_row("after: shared clients", timings, peak))
+
+    print("\nFull upload (DoubtSolver construction, 20 page PDF)")
+    from artifact_store import ArtifactStore
+    from flask_app import DoubtSolver
+
+    pdf = make_pdf()
+    timings, peak = measure(lambda: baseline_upload(pdf), args.runs)
+    print(format_row("before: parse, extract, new clients", timings, peak))
+    # A new empty store each run, so every upload is a deck the server has never seen
+    stores = [ArtifactStore(tempfile.mkdtemp(dir=store_dir)) for _ in range(args.runs)]
+    timings, peak = measure(lambda: DoubtSolver(io.BytesIO(pdf), store=stores.pop()), args.runs)
+    print(format_row("after: DoubtSolver(pdf), new deck", timings, peak))
+    warm_store = ArtifactStore(os.path.join(store_dir, 'warm'))
+    DoubtSolver(io.BytesIO(pdf), store=warm_store)
+    timings, peak = measure(lambda: DoubtSolver(io.BytesIO(pdf), store=warm_store), args.runs)
+    print(format_row("after: DoubtSolver(pdf), known deck", timings, peak))
+    shutil.rmtree(store_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
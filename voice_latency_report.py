@@ -0,0 +1,283 @@
+import argparse
+import io
+import json
+import math
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from array import array
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'solution_deployment_using_flask'))
+sys.path.insert(0, ROOT)
+
+from voice_session import SAMPLE_RATE, SAMPLE_WIDTH, VoiceSession
+
+CHUNK_MS = 20
+SESSION_ID = 'voice-latency-report'
+ANSWER = ("A derivative measures how fast a function changes at a point. On this slide it is the slope of the "
+          "tangent line. We will use it next week to find the minimum of the loss function.")
+
+
+def tone(duration_ms, amplitude=8000, frequency=220):
+    samples = int(SAMPLE_RATE * duration_ms / 1000)
+    return array('h', (int(amplitude * math.sin(2 * math.pi * frequency * i / SAMPLE_RATE))
+                       for i in range(samples))).tobytes()
+
+
+def silence(duration_ms):
+    return bytes(int(SAMPLE_RATE * duration_ms / 1000) * SAMPLE_WIDTH)
+
+
+def chunks(pcm):
+    size = SAMPLE_RATE * CHUNK_MS // 1000 * SAMPLE_WIDTH
+    return [pcm[i:i + size] for i in range(0, len(pcm), size)]
+
+
+class StubSpeechToText:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def transcribe(self, pcm, sample_rate):
+        time.sleep(self.latency)
+        return "What is a derivative?"
+
+
+class StubModel:
+    # Yields the answer word by word like a Bedrock response stream, and notes when the stream is closed early
+    def __init__(self, first_token_latency, token_interval):
+        self.first_token_latency = first_token_latency
+        self.token_interval = token_interval
+        self.closed_early = 0
+
+    def stream_answer(self, question):
+        time.sleep(self.first_token_latency)
+        words = ANSWER.split(' ') if question.endswith('?') else f"{question} {ANSWER}".split(' ')
+        try:
+            for i, word in enumerate(words):
+                yield word if i == 0 else ' ' + word
+                time.sleep(self.token_interval)
+        except GeneratorExit:
+            self.closed_early += 1
+            raise
+
+
+class StubEventStream:
+    # Shaped like the body of a Bedrock invoke_model_with_response_stream response
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.closed = False
+
+    def __iter__(self):
+        for token in self.tokens:
+            delta = {'type': 'content_block_delta', 'delta': {'text': token}}
+            yield {'chunk': {'bytes': json.dumps(delta).encode('utf-8')}}
+
+    def close(self):
+        self.closed = True
+        self.tokens.close()
+
+
+class StubBedrock:
+    def __init__(self, model):
+        self.model = model
+        self.streams = []
+
+    def invoke_model_with_response_stream(self, modelId, body):
+        # Each answer starts differently so its audio is never already in the artifact store
+        stream = StubEventStream(self.model.stream_answer(f"Answer number {len(self.streams) + 1}."))
+        self.streams.append(stream)
+        return {'body': stream}
+
+
+class StubPolly:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def synthesize_speech(self, Text, OutputFormat, VoiceId):
+        time.sleep(self.latency)
+        return {'AudioStream': io.BytesIO(b'ID3' + Text.encode('utf-8'))}
+
+
+class StubTextToSpeech:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def synthesize(self, text):
+        time.sleep(self.latency)
+        return b'ID3' + text.encode('utf-8')
+
+
+class Client:
+    # Collects what the session sends back, as the browser would
+    def __init__(self):
+        self.events = []
+        self.audio_chunks = 0
+        self.done = threading.Event()
+
+    def send(self, message):
+        if isinstance(message, bytes):
+            self.audio_chunks += 1
+            return
+        event = json.loads(message)
+        self.events.append(event)
+        if event['type'] in ('answer_done', 'error'):
+            self.done.set()
+
+
+def stream_audio(session, pcm, feed_times):
+    # Chunks are fed at the pace a microphone would produce them
+    for chunk in chunks(pcm):
+        t = time.perf_counter()
+        session.feed_audio(chunk)
+        feed_times.append(time.perf_counter() - t)
+        time.sleep(CHUNK_MS / 1000)
+
+
+def run_question(args):
+    client = Client()
+    model = StubModel(args.llm_latency, args.token_interval)
+    session = VoiceSession(client.send, StubSpeechToText(args.stt_latency), model.stream_answer,
+                           StubTextToSpeech(args.tts_latency))
+    feed_times = []
+    stream_audio(session, tone(1200) + silence(1000), feed_times)
+    client.done.wait(30)
+    session.close()
+    done = [event for event in client.events if event['type'] == 'answer_done'][0]
+    return done['timings'], client.audio_chunks, max(feed_times)
+
+
+def run_interruption(args):
+    # The student starts a second question while the first answer is still being spoken
+    client = Client()
+    model = StubModel(args.llm_latency, args.token_interval)
+    session = VoiceSession(client.send, StubSpeechToText(args.stt_latency), model.stream_answer,
+                           StubTextToSpeech(args.tts_latency))
+    feed_times = []
+    stream_audio(session, tone(800) + silence(900), feed_times)
+    while not any(event['type'] == 'answer_token' for event in client.events):
+        time.sleep(0.01)
+    stream_audio(session, tone(800) + silence(900), feed_times)
+    deadline = time.monotonic() + 30
+    while sum(event['type'] == 'answer_done' for event in client.events) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    session.close()
+    done = [event for event in client.events if event['type'] == 'answer_done']
+    return [event['interrupted'] for event in done], model.closed_early, max(feed_times)
+
+
+def make_pdf():
+    import fitz
+
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), "Derivatives\nThe slope of the tangent line")
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def run_server(args):
+    # The real Flask app on a local port, with stand-ins behind DoubtSolver, driven over an actual WebSocket
+    os.environ['DOUBT_SOLVER_STORE'] = tempfile.mkdtemp(prefix='voice_latency_report_')
+    import requests
+    import simple_websocket
+    from werkzeug.serving import make_server
+
+    import flask_app
+    from aws_clients import ResilientClient
+    from conversation_memory import ConversationMemory, format_turns
+
+    flask_app.GoogleSpeechToText = lambda: StubSpeechToText(args.stt_latency)
+    server = make_server('127.0.0.1', 0, flask_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"127.0.0.1:{server.server_port}"
+    response = requests.post(f"http://{base_url}/upload_pdf", files={'file': ('deck.pdf', make_pdf(), 'application/pdf')})
+    response.raise_for_status()
+    bedrock = StubBedrock(StubModel(args.llm_latency, args.token_interval))
+    flask_app.doubt_solver.bedrock = ResilientClient(bedrock, 'bedrock-runtime')
+    flask_app.doubt_solver.polly = ResilientClient(StubPolly(args.tts_latency), 'polly')
+    # Past a few questions the conversation is summarized; keep that off Bedrock as well
+    flask_app.conversations[SESSION_ID] = ConversationMemory(lambda summary, turns: format_turns(turns))
+
+    results = []
+    for _ in range(args.runs):
+        ws = simple_websocket.Client(f"ws://{base_url}/voice_session", headers={'X-Session-Id': SESSION_ID})
+        events, first_audio_at = [], []
+
+        def receive():
+            while True:
+                message = ws.receive()
+                if isinstance(message, bytes):
+                    if not first_audio_at:
+                        first_audio_at.append(time.perf_counter())
+                    continue
+                events.append(json.loads(message))
+                if events[-1]['type'] in ('answer_done', 'error'):
+                    return
+
+        receiver = threading.Thread(target=receive, daemon=True)
+        receiver.start()
+        ws.send(json.dumps({'type': 'start', 'sample_rate': SAMPLE_RATE}))
+        speech = chunks(tone(1200))
+        for chunk in speech:
+            ws.send(chunk)
+            time.sleep(CHUNK_MS / 1000)
+        speech_ended_at = time.perf_counter()
+        for chunk in chunks(silence(1000)):
+            ws.send(chunk)
+            time.sleep(CHUNK_MS / 1000)
+        receiver.join(30)
+        ws.close()
+        done = [event for event in events if event['type'] == 'answer_done']
+        if not done or not first_audio_at:
+            print(f"no answer received: {events}")
+            sys.exit(1)
+        results.append((done[0]['timings'], (first_audio_at[0] - speech_ended_at) * 1000))
+    server.shutdown()
+    return results, sum(stream.closed for stream in bedrock.streams), len(bedrock.streams)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure voice session latency with stand-in speech-to-text, model and text-to-speech")
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--stt-latency', type=float, default=0.25)
+    parser.add_argument('--llm-latency', type=float, default=0.1)
+    parser.add_argument('--token-interval', type=float, default=0.02)
+    parser.add_argument('--tts-latency', type=float, default=0.1)
+    parser.add_argument('--server', action='store_true',
+                        help="run the Flask app's /voice_session route on a local port and connect over WebSocket")
+    args = parser.parse_args()
+
+    print(f"Stand-ins: STT {args.stt_latency * 1000:.0f} ms, first token {args.llm_latency * 1000:.0f} ms, "
+          f"{args.token_interval * 1000:.0f} ms per token, TTS {args.tts_latency * 1000:.0f} ms per sentence\n")
+    if args.server:
+        results, closed, streams = run_server(args)
+        for key in ('transcript_ms', 'first_token_ms', 'speech_end_to_first_audio_ms', 'answer_ms'):
+            values = [timings[key] for timings, _ in results]
+            print(f"{key:<32} median {statistics.median(values):8.1f} ms   max {max(values):8.1f} ms")
+        values = [client_ms for _, client_ms in results]
+        print(f"{'first audio seen by the client':<32} median {statistics.median(values):8.1f} ms   max {max(values):8.1f} ms")
+        print(f"{'model streams closed':<32} {closed} of {streams}")
+        if closed != streams:
+            sys.exit(1)
+        return
+
+    results = [run_question(args) for _ in range(args.runs)]
+    for key in ('transcript_ms', 'first_token_ms', 'speech_end_to_first_audio_ms', 'answer_ms'):
+        values = [timings[key] for timings, _, _ in results]
+        print(f"{key:<32} median {statistics.median(values):8.1f} ms   max {max(values):8.1f} ms")
+    print(f"{'audio chunks per answer':<32} {results[0][1]}")
+    print(f"{'longest feed_audio call':<32} {max(feed for _, _, feed in results) * 1000:8.1f} ms")
+
+    interrupted, closed_early, feed = run_interruption(args)
+    print(f"\nInterruption: answers interrupted {interrupted}, model streams closed early {closed_early}, "
+          f"longest feed_audio call {feed * 1000:.1f} ms")
+    if interrupted != [True, False] or closed_early != 1:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()